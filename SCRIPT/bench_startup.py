@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+
+'''
+Startup time of the SCRIPT python tools: each script is imported in a fresh
+interpreter (its main() is not run), and the time above the bare interpreter
+start-up is reported along with the heaviest modules it imports.
+
+    bench_startup.py                        # all the scripts of SCRIPT
+    bench_startup.py reduce_fields.py -n 5  # best of 5 runs
+    bench_startup.py -b 1.0                 # exit status 1 if a script takes more than 1 s
+
+Scripts without a __name__=="__main__" guard would run on import and are skipped.
+'''
+
+import os
+import sys
+import glob
+import time
+import argparse
+import subprocess
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def run_import(code, repeat):
+    '''
+    Best wall time (s) of `python -X importtime -c code` over repeat runs, with
+    the importtime report of the best run, or the error of a failed import.
+    '''
+    best, report = None, ""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=SCRIPT_DIR,
+                              capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+        if proc.returncode != 0:
+            return None, proc.stderr.strip().splitlines()[-1]
+        if best is None or elapsed < best:
+            best, report = elapsed, proc.stderr
+    return best, report
+
+def heaviest_imports(report, count=3):
+    '''
+    Packages imported by the script with the largest cumulative import time, from an importtime report.
+    '''
+    packages = {}
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if len(name) - len(name.lstrip()) != 3: # only the modules imported by the script itself
+            continue
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(cumulative)
+    top = sorted(packages.items(), key=lambda item: -item[1])[:count]
+    return ", ".join(f"{name} {usec/1e6:.2f}s" for name, usec in top)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scripts", nargs="*", help="scripts to time (default all the scripts of SCRIPT)")
+    parser.add_argument("-n", "--repeat", dest="repeat", type=int, default=3, help="number of runs per script, the best one is reported (default 3)")
+    parser.add_argument("-b", "--budget", dest="budget", type=float, help="startup time budget (s), exit status 1 if a script exceeds it")
+    args = parser.parse_args()
+
+    scripts = args.scripts or sorted(glob.glob(os.path.join(SCRIPT_DIR, "*.py")))
+    baseline, _ = run_import("pass", args.repeat)
+    print(f"{'script':32s} {'startup':>8s}  heaviest imports (interpreter start-up {baseline:.2f}s not included)")
+
+    over_budget = []
+    for script in scripts:
+        name = os.path.basename(script)
+        with open(os.path.join(SCRIPT_DIR, name)) as f:
+            if "__main__" not in f.read():
+                print(f"{name:32s} {'skipped':>8s}  (no main guard)")
+                continue
+        elapsed, report = run_import(f"import {name[:-3]}", args.repeat)
+        if elapsed is None:
+            print(f"{name:32s} {'failed':>8s}  {report}")
+            continue
+        elapsed -= baseline
+        print(f"{name:32s} {elapsed:7.2f}s  {heaviest_imports(report)}")
+        if args.budget is not None and elapsed > args.budget:
+            over_budget.append(name)
+
+    if over_budget:
+        print(f"Over the {args.budget}s budget: {' '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__=="__main__":
+    main()
@@ -1,11 +1,7 @@
-from util import filter_lat_lon
+from util import filter_lat_lon, read_tmask
 import argparse # 1.1
 import xarray as xr # 2025.1.2
 import numpy as np # 2.2.3
-import matplotlib.pyplot as plt
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-import gsw
 import warnings
 from xarray import SerializationWarning
 warnings.filterwarnings("ignore", category=SerializationWarning)
@@ -28,6 +24,7 @@ def load_argument():
     parser.add_argument("-marvaldir", metavar='Marine val directory', help="directory of marine val", type=str, nargs=1, required=True)
     # flags
     parser.add_argument("-obs", help="Flag to indicate if obs data is used", action='store_true')
+    parser.add_argument("-noplot", help="Flag to skip the maps of the outputs", action='store_true')
     # parse args
     args = parser.parse_args()
     # assertions
@@ -51,30 +48,26 @@ def load_argument():
 
     return args
 
-def get_bounds(tmask, args):
+def get_bounds(tmask_file, args):
     """
-    Get the bounds of the tmask array based on the valid ocean points.
+    Get the bounds of the tmask array based on the valid ocean points, from the offsets
+    stored in compact tmask files (legacy full tmask files are cropped on reading).
+    Returns the tmask cropped to these bounds.
     """
-    nav_lev_sums = [int(tmask.isel(nav_lev=i).sum().values) for i in range(tmask.sizes['nav_lev'])]
-    z_min = next((i for i, s in enumerate(nav_lev_sums) if s > 0), None)
-    if z_min is None:
+    mask, box, shape = read_tmask(tmask_file)
+    if not mask.any():
         raise ValueError("No valid ocean points found.")
-    z_max = next((i for i, s in reversed(list(enumerate(nav_lev_sums))) if s > 0), None)
-    z_max = z_max + 1 if z_max < tmask.sizes['nav_lev'] - 1 else None
 
-    tmask_squeezed = tmask.isel(nav_lev=z_min)
-    y_indices, x_indices = np.where(tmask_squeezed.values)
+    # slice ends are None when the box reaches the end of the grid, as in the original ranges
+    z_range, y_range, x_range = [[bounds.start, bounds.stop if bounds.stop < n else None] for bounds, n in zip(box, shape)]
 
-    y_min, y_max = (y_indices.min(), y_indices.max()) 
-    x_min, x_max = (x_indices.min(), x_indices.max()) 
-    y_min, y_max = (y_min, y_max + 1) if y_max < tmask.sizes['y'] - 1 else (y_min, None)
-    x_min, x_max = (x_min, x_max + 1) if x_max < tmask.sizes['x'] - 1 else (x_min, None)
+    # print(f"z_min: {z_range[0]}, z_max: {z_range[1]}, y_min: {y_range[0]}, y_max: {y_range[1]}, x_min: {x_range[0]}, x_max: {x_range[1]}")
 
-    # print(f"z_min: {z_min}, z_max: {z_max}, y_min: {y_min}, y_max: {y_max}, x_min: {x_min}, x_max: {x_max}")
+    args.z_range = z_range
+    args.y_range = y_range
+    args.x_range = x_range
 
-    args.z_range = [z_min, z_max]
-    args.y_range = [y_min, y_max]
-    args.x_range = [x_min, x_max]
+    return xr.DataArray(mask, dims=('nav_lev', 'y', 'x'), name='tmask')
 
 def crop_grid(array, args, depth=False):
     """
@@ -102,21 +95,16 @@ def restore_grid(array_like, output, args):
     return uncropped
 
 def calc_sigma4(data, tmask, mesh, args):
+    from seawater_state import open_state # sigma4 is computed once per data file and kept alongside it
     
     args.diagvar = 'sigma4'
 
-    # Prepare inputs
-    latitude = crop_grid(data['nav_lat'], args, depth=False)
-    longitude = crop_grid(data['nav_lon'], args, depth=False)
-    salinity = crop_grid(data[args.salvar[0]], args, depth=True) # practical salinity 
-    temperature = crop_grid(data[args.tempvar[0]], args, depth=True) # potential temperature
-    depth = crop_grid(mesh['gdept_0'].isel({'time_counter':0}), args, depth=True) # nk x nj x ni array, depth levels
-    
-    # Calculate sigma4 density
-    pressure = gsw.p_from_z(-depth, latitude)
-    salinity = gsw.SA_from_SP(salinity, pressure, longitude, latitude) # absolute salinity
-    temperature = gsw.CT_from_pt(salinity, temperature) # conservative temperature
-    sigma4 = gsw.density.sigma4(salinity, temperature) # potential density referenced to 4000 dba
+    # Read sigma4 (potential density referenced to 4000 dba) in the state of the data file,
+    # whose sea pressure is computed from the depth of the mesh levels
+    state = open_state(args.datf[0], ['sigma4'], temp=args.tempvar[0], sal=args.salvar[0], mesh=args.meshf[0], depth_var='gdept_0')
+    with xr.open_dataset(xr.backends.NetCDF4DataStore(state)) as ds:
+        sigma4 = ds['sigma4'].rename({ds['sigma4'].dims[-3]: 'nav_lev'})
+        sigma4 = crop_grid(sigma4, args, depth=True).load()
     density_mask = (sigma4 > args.densthresh[0])
 
     # Calculate cell volume 
@@ -206,6 +194,10 @@ def calc_max_diag(data, tmask, mesh, args):
     return [uncropped_max_diag, uncropped_max_depth]
 
 def plot_map(output, mesh, args, i):
+    # plotting libraries are only imported when maps are drawn
+    import matplotlib.pyplot as plt
+    import cartopy.crs as ccrs
+    import cartopy.feature as cfeature
     
     time = 0
     pad = 3
@@ -280,9 +272,7 @@ def main():
 
     ### Load data ###
     # Load and prepare tmask
-    tmask = xr.open_dataset(args.tmask[0])['tmask'] # nk x nj x ni array, 1 for ocean, 0 for land
-    get_bounds(tmask, args) # Extract bounds useful for cropping, where tmask values are 1
-    tmask = crop_grid(tmask, args, depth=True) # 1 x nj x ni array, 0 for all values outside the domain
+    tmask = get_bounds(args.tmask[0], args) # Extract bounds useful for cropping, where tmask values are 1, and the cropped nk x nj x ni tmask, 0 for all values outside the domain
     # Load diagnostics
     data = xr.open_dataset(args.datf[0], drop_variables=drop_variables, decode_times=decode_times).rename_dims({args.depthvar[0]:'nav_lev'})
     args.depthvar = ['nav_lev']
@@ -301,6 +291,8 @@ def main():
         outputs = calc_max_diag(data, tmask, mesh, args)
     
     # Plot outputs
+    if args.noplot:
+        return
     for i, df in enumerate(outputs):
         plot_map(df, mesh, args, i)
 
@@ -1,15 +1,13 @@
-import nsv
 import xarray as xr
 import numpy as np
 import netCDF4 as nc
 import sys
-import gsw
 import os
-import sklearn #needed for section finder
 
 
 def add_density_to_obs(obs_ds, timevar):
     # Computing potential density anomaly and adding to observational dataset
+    from seawater_state import get_pressure, teos10_state
 
     lon = obs_ds.longitude.values  # [ni]
     lat = obs_ds.latitude.values  # [ni]
@@ -17,25 +15,9 @@ def add_density_to_obs(obs_ds, timevar):
     PT = obs_ds.potential_temperature.values  # Potential temperature [nt,nk,ni]
     PS = obs_ds.practical_salinity.values  # Practical salinity [nt,nk,ni]
 
-    if timevar:
-        ni = PT.shape[2]
-        nk = PT.shape[1]
-        nt = PT.shape[0] #time
-    else:
-        ni = PT.shape[1]
-        nk = PT.shape[0]
-
-    depth2d = np.repeat(depth[:, np.newaxis], ni, axis=1)
-    pressure2d = gsw.p_from_z(-depth2d, lat)  # http://www.teos-10.org/pubs/gsw/html/gsw_p_from_z.html
-    lon2d = np.repeat(lon[np.newaxis, :], nk, axis=0)
-    lat2d = np.repeat(lat[np.newaxis, :], nk, axis=0)
-
-    AS = gsw.SA_from_SP(PS, pressure2d, lon2d,
-                        lat2d)  # absolute salinity #http://www.teos-10.org/pubs/gsw/html/gsw_SA_from_SP.html
-
-    CT = gsw.CT_from_pt(AS, PT)  # conservative temperature #http://teos-10.org/pubs/gsw/html/gsw_CT_from_pt.html
+    pressure2d = get_pressure(depth, lat)  # [nk,ni]
 
-    rho = gsw.density.sigma0(AS, CT)
+    rho = teos10_state(PT, PS, pressure2d, lon, lat, ["sigma0"])["sigma0"]  # TEOS-10 potential density anomaly, as for the model
 
     if timevar:
         obs_ds['sigma_theta'] = xr.DataArray(data=rho, dims=["time", "depth", "station"],
@@ -50,6 +32,7 @@ def add_density_to_obs(obs_ds, timevar):
 def create_obs_overflow_data_locally(dir):
 
     # Selecting model data at observational overflow cross sections in NA subpolar gyre
+    import nsv
 
     section_osnap_obs = nsv.Standardizer().osnap
     section_osnap_obs = add_density_to_obs(section_osnap_obs, timevar=True)
@@ -80,6 +63,7 @@ def extract_model_at_Xsection(ds_obs, domain, ds_tgrid, obs_name, runid):
     if obs_name == 'ovide':
         ds_obs = ds_obs.drop(["mid_longitude", "mid_latitude"])
 
+    import nsv # the section finder also needs sklearn installed
     finder = nsv.SectionFinder(domain)
 
     stations = finder.nearest_neighbor(
@@ -11,73 +11,72 @@ in depth space accross a model transect.
 import sys
 import numpy as np
 import xarray as xr
-import nsv
-import gsw
+
+def section_sums(ds):
+    '''
+    Sums along the section (x) of the masked transport vo*e3v_0*e1v and of
+    the masked cell area, with the area itself (masked), for the time steps of ds.
+    '''
+    area = (ds.e3v_0 * ds.e1v).where(ds.vmask==1, 0.)
+    vnorm = ds.vo.where(ds.vmask==1, 0.)
+    return (vnorm * area).sum(dim='x').transpose('time_counter', ...).values, area.sum(dim='x').values, area
+
+def moc_depth(ds, int_dir, tblock=None):
+    '''
+    Overturning streamfunction (Sv) at each time step and depth of the section,
+    integrated from the top ("top2bot") or from the bottom ("bot2top"), after
+    removing the mean net transport through the section (as done in obs).
+    With tblock, the section is read tblock time steps at a time.
+    '''
+    stp = {"top2bot": 1, "bot2top": -1}[int_dir]
+    nt = ds.time_counter.size
+    tblock = tblock or nt
+
+    vflux_x, area_x = [], []
+    area_sum = 0.
+    for t0 in range(0, nt, tblock):
+        block = ds.isel(time_counter=slice(t0, t0+tblock)).load()
+        vflux_blk, area_blk, area = section_sums(block)
+        vflux_x.append(vflux_blk)
+        if 'time_counter' in area.dims:
+            area_x.append(area_blk)
+            area_sum += area.values.sum()
+        elif t0 == 0:
+            area_x, area_sum = area_blk, area.values.sum() # static area, the same for all the blocks
+    vflux_x = np.concatenate(vflux_x, axis=0)
+    if isinstance(area_x, list):
+        area_x = np.concatenate(area_x, axis=0)
+
+    # x-integral of the transport without the mean net transport, in Sv
+    avg_vnorm = vflux_x.sum() / area_sum
+    xint = -(vflux_x - avg_vnorm * area_x) / 1.e6
+
+    return xint[:, ::stp].cumsum(axis=1)[:, ::stp]
 
 if __name__ == "__main__":
 
      Fsection = sys.argv[1] # NetCDF file of the brokenline section
      label    = sys.argv[2] # to be used on the name of the output file 
      int_dir  = sys.argv[3] # direction of integration: "top2bot" or "bot2top"
+     tblock   = int(sys.argv[4]) if len(sys.argv) > 4 else None # optional: number of time steps read at a time
+
+     if int_dir not in ("top2bot", "bot2top"):
+        print('Error: direction of integration not recognised!')
+        quit()
 
      ds = xr.open_dataset(Fsection).squeeze(dim='y')
-     #ds = ds.rename_dims({'time_counter':'t','deptht':'z'})
 
-     vnorm = ds.vo
      timed = ds.time_centered#.data
      depthw = ds.gdepw_1d.squeeze().data
 
-     #MODEL grid metrics       
-     zz = ds.e3v_0
-     xx = ds.e1v
-     #xx = np.repeat(xx[:,np.newaxis,:], zz.shape[0], axis=1)
-     # Land-sea mask
-     mask = ds.vmask
-
-     # Grid cell area
-     area = zz * xx
-
-     # Mask the area and vnorm
-     area  = area.where(mask==1, 0.)
-     vnorm = vnorm.where(mask==1, 0.)
- 
-     # Compute velocity field after removing net transport through section
-     # (as done in obs)
-     avg_vnorm = (vnorm * area).sum() / area.sum()
-     vnorm_no_net = vnorm - avg_vnorm
-
-     # Vflux
-     vflux = vnorm_no_net * area
-
-     # Dealing with the vertical integration direction
-     if int_dir == "top2bot":
-        stp = 1
-     elif int_dir == "bot2top":
-        stp = -1
-     else:
-        print('Error: direction of integration not recognised!')
-        quit()
-
-     # Compute MOC from flux in density bins
      print('Compute the overturning streamfunction in depth coordinates')
-     nt = vflux.time_counter.size
-     nz = vflux.deptht.size
-     ny = 1
-     nx = 1
-     MOC_z = np.zeros((nt, nz, ny, nx))
-     for t in range(nt):
-         # Integrate along x
-         xint = -vflux[t,:,:].sum(dim='x').values
-         # Convert from m3/s to Sv
-         xint = xint / 1.e6
-         # integrate bottom to top
-         MOC_z[t,:,0,0] = xint[::stp].cumsum()[::stp]
+     MOC_z = moc_depth(ds, int_dir, tblock=tblock)[:, :, np.newaxis, np.newaxis] # time_counter x depthw x y x x
 
      # Saving datarray and netCDF file
      ds_moc = xr.Dataset(
                    data_vars=dict(
-                         amoc_rapid=(["time_counter", "depthw","y","x"], MOC_z.data),
-                         Total_max_amoc_rapid=(["time_counter","y","x"], np.nanmax(MOC_z.data, axis=1)), 
+                         amoc_rapid=(["time_counter", "depthw","y","x"], MOC_z),
+                         Total_max_amoc_rapid=(["time_counter","y","x"], np.nanmax(MOC_z, axis=1)), 
                    ),
                    coords=dict(
                          time_centered=(["time_counter"]), #timed),
@@ -89,4 +88,3 @@ if __name__ == "__main__":
 
      enc = {"time_centered"        : {"_FillValue": None }}
      ds_moc.to_netcdf('moc_z_' + label + '.nc', encoding=enc, unlimited_dims={'time_counter':True})
-
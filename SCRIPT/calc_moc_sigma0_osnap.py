@@ -13,30 +13,28 @@ import numpy as np
 import xarray as xr
 import nsv
 import gsw
+from seawater_state import get_pressure, teos10_state
 
 
 def compute_potential_sigma(ds):
-    # Absolute Salinity
-    press = gsw.p_from_z(-ds.depth, ds.latitude)
-    abs_s = gsw.SA_from_SP(ds.practical_salinity,
-                           press,
-                           ds.longitude,
-                           ds.latitude
+    # Potential density anomaly (TEOS-10) of the t x z x x section
+    press = get_pressure(ds.depth.values, ds.latitude.values)
+    state = teos10_state(ds.potential_temperature.values,
+                         ds.practical_salinity.values,
+                         press,
+                         ds.longitude.values,
+                         ds.latitude.values,
+                         ["sigma0"]
     )
-    # Conservative Temperature
-    con_t = gsw.CT_from_pt(abs_s,
-                           ds.potential_temperature
-    )
-    # Potential density anomaly
-    ds['sigma_theta'] = gsw.density.sigma0(abs_s, con_t)
+    ds['sigma_theta'] = (ds.practical_salinity.dims, state["sigma0"])
 
     return ds
 
-def depth2rho(vflux, rho, minsig, maxsig, stpsig):
+def depth2rho(vflux, rho, minsig, maxsig, stpsig, thickness=None):
     bins      = np.arange(minsig, maxsig, stpsig)
     bins_sect = 0.5*(bins[1:]+bins[:-1])
  
-    vflux_rho = rho_bin_loop(vflux, rho, bins)   
+    vflux_rho = rho_bin(vflux, rho, bins, thickness=thickness)
  
     vflux_rho = xr.DataArray(
                      data=vflux_rho,
@@ -46,21 +44,60 @@ def depth2rho(vflux, rho, minsig, maxsig, stpsig):
 
     return bins_sect, vflux_rho      
 
-def rho_bin_loop(vflux, rho, bins):
-    nt  = vflux.shape[0]
-    nx  = vflux.shape[2]
-    nbins = len(bins)
-
-    vflux_rho = np.zeros((nt,nx,nbins-1))
-
-    for t in range(nt):
-        print('time-step', t)
-        for i in range(nx):
-            for r in range(nbins-1):
-                indexes = np.where((rho[t,:,i]>=bins[r])&(rho[t,:,i]<bins[r+1]))
-                vflux_rho[t,i,r] = np.nansum(vflux[t,indexes,i])
-
-    return vflux_rho
+def rho_bin(vflux, rho, bins, thickness=None):
+    '''
+    Sum of the t x z x x fluxes vflux in the density bins [bins[r], bins[r+1])
+    of each time step and station, as a t x x x (nbins-1) array.
+
+    Each cell is binned at its density rho. If the t x z x x (or z x x) cell
+    thicknesses are given, the density of a cell is instead taken as varying
+    linearly between its interfaces (interpolated from the neighbouring cells,
+    weighted by their thickness) and its flux is shared among all the bins
+    this range overlaps, in proportion to the overlap.
+    Cells with a masked or NaN flux or density are ignored.
+    '''
+    nt, nz, nx = vflux.shape
+    nbins = len(bins) - 1
+
+    vflux = np.ma.filled(np.ma.masked_invalid(vflux), 0.)
+    rho = np.ma.filled(np.ma.masked_invalid(rho), np.nan)
+    valid = ~np.isnan(rho)
+
+    if thickness is None:
+        rho_lo = rho_hi = rho
+    else:
+        dz = np.broadcast_to(np.ma.filled(thickness, 0.), rho.shape)
+        # density at the interfaces with the cells above and below,
+        # the cell's own density next to the surface, the bottom or land
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rho_if = (rho[:,:-1]*dz[:,1:] + rho[:,1:]*dz[:,:-1]) / (dz[:,:-1] + dz[:,1:])
+        rho_up = rho.copy()
+        rho_up[:,1:] = np.where(np.isnan(rho_if), rho[:,1:], rho_if)
+        rho_dn = rho.copy()
+        rho_dn[:,:-1] = np.where(np.isnan(rho_if), rho[:,:-1], rho_if)
+        rho_lo = np.fmin(rho_up, rho_dn)
+        rho_hi = np.fmax(rho_up, rho_dn)
+
+    # flattened (t, x) index of each cell, bins of both ends of its density range
+    tx = (np.arange(nt)[:,None,None]*nx + np.arange(nx)[None,None,:]).repeat(nz, axis=1)[valid]
+    lo, hi, flux = rho_lo[valid], rho_hi[valid], vflux[valid]
+    r_lo = np.searchsorted(bins, lo, side='right') - 1
+    r_hi = np.searchsorted(bins, hi, side='right') - 1
+    span = hi - lo
+
+    vflux_rho = np.zeros(nt*nx*nbins)
+    for j in range(int((r_hi - r_lo).max(initial=0)) + 1):
+        r = r_lo + j
+        inbin = (r <= r_hi) & (r >= 0) & (r < nbins)
+        rb = np.clip(r, 0, nbins-1)
+        overlap = np.minimum(hi, bins[rb+1]) - np.maximum(lo, bins[rb])
+        frac = np.where(span > 0, overlap / np.where(span > 0, span, 1.), 1.)
+        vflux_rho += np.bincount(tx[inbin]*nbins + rb[inbin],
+                                 weights=(flux*frac)[inbin],
+                                 minlength=nt*nx*nbins
+                     )
+
+    return vflux_rho.reshape(nt, nx, nbins)
 
 if __name__ == "__main__":
 
@@ -69,6 +106,8 @@ if __name__ == "__main__":
      minsig   = float(sys.argv[3])
      maxsig   = float(sys.argv[4])
      stpsig   = float(sys.argv[5])
+     # optional: 'subcell' to share the flux of each cell among the bins its density range overlaps
+     interp   = sys.argv[6] if len(sys.argv) > 6 else 'none'
 
      print(Fsection)
 
@@ -142,7 +181,8 @@ if __name__ == "__main__":
                                       rho=s_sect.values,
                                       minsig=minsig,
                                       maxsig=maxsig,
-                                      stpsig=stpsig
+                                      stpsig=stpsig,
+                                      thickness=zz if interp == 'subcell' else None
                             )
 
      # Compute MOC from flux in density bins
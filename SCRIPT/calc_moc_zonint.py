@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+'''
+Zonally integrated overturning streamfunctions of the global ocean and of
+the sub-basins of subbasinmask_amoc.nc, in depth space (as cdfmoc) or in
+sigma-2000 space (as cdfmocsig -r 2000), written with the names of the
+CDFTOOLS outputs (zomsfglo, zomsfatl, ... on depthw or sigma).
+
+The grid is cut into blocks of time steps and bands of latitude of about
+the chunk size, processed in parallel on a pool of local processes, so that
+the memory used does not depend on the size of the grid or of the record.
+'''
+
+import os
+import argparse
+import numpy as np
+import xarray as xr
+import netCDF4 as nc4
+from concurrent.futures import ProcessPoolExecutor
+from util import read_box
+from seawater_state import open_state
+
+CHUNK_SIZE = 64 # MiB of each input field read by a task
+
+# Basins of the outputs (CDFTOOLS suffixes), as the masks of the sub-basin file they cover
+# (gen_subbasinmask.py), the global ocean being all the ocean points
+BASINS = {
+     "glo": ("Global", ()),
+     "atl": ("Atlantic", ("atlmsk",)),
+     "inp": ("Indo-Pacific", ("indmsk", "pacmsk")),
+     "ind": ("Indian", ("indmsk",)),
+     "pac": ("Pacific", ("pacmsk",)),
+}
+
+SIGMA2_BINS = (30., 38., 0.05) # first edge, last edge and width of the sigma-2000 bins
+
+def load_argument():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", dest="vfile", metavar="V file", help="file of the meridional velocity", type=str, required=True)
+    parser.add_argument("-t", dest="tfile", metavar="T file", help="file of the potential temperature and practical salinity, for the streamfunction in sigma-2000 space", type=str)
+    parser.add_argument("-o", dest="outfile", metavar="output file", help="name of the output file", type=str, required=True)
+    parser.add_argument("-mh", dest="meshh", metavar="mesh file", help="file of e1v and gphiv (default mesh.nc)", type=str, default="mesh.nc")
+    parser.add_argument("-mz", dest="meshz", metavar="mesh file", help="file of e3v_0 and gdepw_1d (default mesh.nc)", type=str, default="mesh.nc")
+    parser.add_argument("-mask", dest="maskf", metavar="mask file", help="file of vmask (default mask.nc)", type=str, default="mask.nc")
+    parser.add_argument("-b", dest="basinf", metavar="basin file", help="sub-basin masks (default subbasinmask_amoc.nc)", type=str, default="subbasinmask_amoc.nc")
+    parser.add_argument("-vvl", dest="vvl", help="read the time varying thickness of the cells (thkcello) in the V file", action="store_true")
+    parser.add_argument("-bins", dest="bins", metavar="sigma bins", help=f"first edge, last edge and width of the sigma-2000 bins (default {' '.join(map(str, SIGMA2_BINS))})", type=float, nargs=3, default=SIGMA2_BINS)
+    parser.add_argument("-n", dest="nproc", metavar="processes", help="number of processes (default $SLURM_CPUS_PER_TASK or the number of CPUs)", type=int,
+                        default=int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count())))
+    parser.add_argument("-c", dest="store", metavar="store", help="directory of the sea pressure store (default $WEIGHTS_STORE)", type=str, default=os.environ.get("WEIGHTS_STORE"))
+    parser.add_argument("-C", dest="chunk_size", metavar="chunk size", help=f"size in MiB of the input fields read by each task (default {CHUNK_SIZE})", type=float, default=CHUNK_SIZE)
+    return parser.parse_args()
+
+def read_static(filename, name, box):
+    '''
+    Reads the box (z, y, x slices) of a time invariant field, dropping its
+    leading time dimension if any.
+    '''
+    with nc4.Dataset(filename) as ds:
+        values = read_box(ds[name], box)
+    return values.reshape(values.shape[-len(box):])
+
+def sigma2_at_v(tfile, tbox, ny, store=None):
+    '''
+    Potential density referenced to 2000 dbar (TEOS-10) at the V points of a
+    block (time, z, y, x slices), from the state of the T file
+    (seawater_state.py) at the T points on both sides. Land points are NaN.
+    '''
+    t, z, y, x = tbox
+    ybox = slice(y.start, min(y.stop + 1, ny)) # T points north of the band
+    with open_state(tfile, ["sigma2"], store=store) as ds:
+        sigma = read_box(ds["sigma2"], (t, z, ybox, x))
+
+    # mean of the T points on both sides of the V points, or the ocean one
+    if ybox.stop == y.stop: # last row of the grid
+        sigma = np.concatenate([sigma, sigma[..., -1:, :]], axis=-2)
+    south, north = sigma[..., :-1, :], sigma[..., 1:, :]
+    return np.where(np.isnan(north), south, np.where(np.isnan(south), north, 0.5*(south + north)))
+
+def moc_task(task):
+    '''
+    Meridional transport of a block of time steps and a band of latitude,
+    integrated along x in each basin, by depth level (or by sigma-2000 bin
+    if bins is given), in Sv.
+
+    Returns the block (t, y slices) and the basins x time x levels (or bins)
+    x band array.
+    '''
+    cfg, t, y = task
+    nz, nx = cfg["nz"], cfg["nx"]
+    z, x = slice(0, nz), slice(0, nx)
+
+    with nc4.Dataset(cfg["vfile"]) as ds:
+        vel = read_box(ds["vo"], (t, z, y, x))
+        e3v = read_box(ds["thkcello"], (t, z, y, x)) if cfg["vvl"] else read_static(cfg["meshz"], "e3v_0", (z, y, x))
+    e1v = read_static(cfg["meshh"], "e1v", (y, x))
+    vmask = read_static(cfg["maskf"], "vmask", (z, y, x))
+
+    trp = np.nan_to_num(vel * e3v * e1v * vmask) / 1.e6 # time x z x band x x, Sv
+    masks = [read_static(cfg["basinf"], name, (y, x)) for name in cfg["masknames"]]
+
+    if cfg["bins"] is None:
+        trp_z = np.empty((len(cfg["basins"]), vel.shape[0], nz, y.stop - y.start))
+        for b, names in enumerate(cfg["basins"]):
+            bmask = np.ones((y.stop - y.start, nx)) if not names else sum(masks[cfg["masknames"].index(n)] for n in names)
+            trp_z[b] = np.einsum("tkji,ji->tkj", trp, bmask)
+        return t, y, trp_z
+
+    smin, smax, sstp = cfg["bins"]
+    nbins = cfg["nbins"]
+    sigma = sigma2_at_v(cfg["tfile"], (t, z, y, x), cfg["ny"], cfg["store"])
+    ibin = np.clip(np.floor((sigma - smin) / sstp), 0, nbins - 1) # out of range densities go to the end bins
+    valid = ~np.isnan(sigma)
+
+    nt, nj = vel.shape[0], y.stop - y.start
+    key = ((np.arange(nt)[:, None, None, None]*nbins + np.where(valid, ibin, 0).astype(np.int64))*nj
+           + np.arange(nj)[None, None, :, None])
+    key = np.broadcast_to(key, trp.shape)[valid]
+    trp_rho = np.empty((len(cfg["basins"]), nt, nbins, nj))
+    for b, names in enumerate(cfg["basins"]):
+        bmask = 1. if not names else sum(masks[cfg["masknames"].index(n)] for n in names)
+        trp_rho[b] = np.bincount(key, weights=(trp * bmask)[valid], minlength=nt*nbins*nj).reshape(nt, nbins, nj)
+    return t, y, trp_rho
+
+def get_tasks(cfg, chunk_size):
+    '''
+    Blocks of time steps and bands of latitude reading about chunk_size MiB
+    of each input field.
+    '''
+    nt, nz, ny, nx = cfg["nt"], cfg["nz"], cfg["ny"], cfg["nx"]
+    row = nz * nx * 8 # bytes of a latitude row of one time step
+    nrows = max(1, int(chunk_size * 2**20 // row))
+    tblock = max(1, nrows // ny)
+    band = min(ny, nrows)
+    return [(cfg, slice(t0, min(t0 + tblock, nt)), slice(j0, min(j0 + band, ny)))
+            for t0 in range(0, nt, tblock) for j0 in range(0, ny, band)]
+
+def calc_moc(vfile, outfile, tfile=None, meshh="mesh.nc", meshz="mesh.nc", maskf="mask.nc", basinf="subbasinmask_amoc.nc",
+             vvl=False, bins=SIGMA2_BINS, nproc=1, chunk_size=CHUNK_SIZE, store=None):
+    '''
+    Computes the overturning streamfunctions of the basins in depth space,
+    or in sigma-2000 space if the T file is given, and saves them in outfile.
+    The sea pressure of the grid is kept in store (seawater_state.py).
+    '''
+    with nc4.Dataset(vfile) as ds:
+        nt, nz, ny, nx = ds["vo"].shape
+    with nc4.Dataset(basinf) as ds:
+        basins = {b: names for b, (_, names) in BASINS.items() if all(n in ds.variables for n in names)}
+    masknames = sorted({n for names in basins.values() for n in names})
+    cfg = dict(vfile=vfile, tfile=tfile, meshh=meshh, meshz=meshz, maskf=maskf, basinf=basinf, vvl=vvl,
+               nt=nt, nz=nz, ny=ny, nx=nx, basins=list(basins.values()), masknames=masknames,
+               bins=None if tfile is None else tuple(bins), store=store)
+    if tfile is not None:
+        open_state(tfile, ["sigma2"], store=store).close() # computed once, before the tasks read it
+        edges = np.arange(bins[0], bins[1] + 0.5*bins[2], bins[2])
+        cfg["nbins"] = len(edges) - 1
+    nlev = nz if tfile is None else cfg["nbins"]
+
+    trp = np.empty((len(basins), nt, nlev, ny))
+    tasks = get_tasks(cfg, chunk_size)
+    if nproc > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            results = pool.map(moc_task, tasks)
+            for t, y, trp_blk in results:
+                trp[:, t, :, y] = trp_blk
+    else:
+        for t, y, trp_blk in map(moc_task, tasks):
+            trp[:, t, :, y] = trp_blk
+
+    if tfile is None:
+        # integrated from the bottom (cdfmoc), at the top of the cells
+        moc = -trp[:, :, ::-1].cumsum(axis=2)[:, :, ::-1]
+        vert = "depthw"
+        with nc4.Dataset(meshz) as ds:
+            vert_values = read_box(ds["gdepw_1d"], (slice(0, nz),)).reshape(nz)
+        vert_attrs = dict(units="m", positive="down", long_name="Vertical W levels")
+    else:
+        # integrated from the lightest bin, at the dense edge of the bins
+        moc = trp.cumsum(axis=2)
+        vert = "sigma"
+        vert_values = edges[1:]
+        vert_attrs = dict(units="kg/m3", long_name="Potential density referenced to 2000 dbar - 1000 (dense edge of the bins)")
+
+    # latitude of the row of the grid going through the northernmost point (as cdfmoc)
+    gphiv = read_static(meshh, "gphiv", (slice(0, ny), slice(0, nx)))
+    lat = gphiv[:, np.unravel_index(np.nanargmax(gphiv), gphiv.shape)[1]]
+
+    with xr.open_dataset(vfile, decode_times=False) as ds:
+        time = ds["time_counter"].load()
+    # nav_lon and nav_lat are variables, not coordinates, as in the CDFTOOLS outputs
+    ds_moc = xr.Dataset(
+                  data_vars=dict(
+                         nav_lon=(["y", "x"], np.zeros((ny, 1), dtype=np.float32)),
+                         nav_lat=(["y", "x"], lat[:, np.newaxis].astype(np.float32)),
+                  ),
+                  coords=dict(time_counter=time),
+             )
+    for n, b in enumerate(basins):
+        ds_moc[f"zomsf{b}"] = xr.DataArray(moc[n, ..., np.newaxis].astype(np.float32), dims=["time_counter", vert, "y", "x"],
+                                           attrs=dict(units="Sv", long_name=f"Meridional Overturning Stream Function: {BASINS[b][0]} Ocean"))
+    ds_moc[vert] = xr.DataArray(vert_values.astype(np.float32), dims=[vert], attrs=vert_attrs)
+
+    enc = {var: {"_FillValue": None} for var in ["nav_lon", "nav_lat", vert, "time_counter"]}
+    ds_moc.to_netcdf(outfile, encoding=enc, unlimited_dims={"time_counter": True})
+
+def main():
+
+    args = load_argument()
+    calc_moc(args.vfile, args.outfile, tfile=args.tfile, meshh=args.meshh, meshz=args.meshz, maskf=args.maskf,
+             basinf=args.basinf, vvl=args.vvl, bins=args.bins, nproc=args.nproc, chunk_size=args.chunk_size,
+             store=args.store)
+
+
+if __name__=="__main__":
+    main()
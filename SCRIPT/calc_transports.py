@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+'''
+Transports through all the sections of a run, from one opening of its U, V
+(and T) files, written with the names and variables of the CDFTOOLS outputs
+used by the plots, named after the sections in their files (first line):
+
+    -s: net, positive and negative transports through the LONLAT section, as
+        cdftransport -lonlat -pm: <section>_<sfx>.nc with vtrp, ptrp, mtrp
+    -b: the same with the bottom velocity over the whole water column (as
+        bottom_field.py --3D in mk_trp.bash -B): <section>_bottom_<sfx>.nc
+    -sig: transport of the XTRAC section in potential density (sigma-0)
+        classes, as cdfsigtrp -brk: <xsec><section>_trpsig.nc with
+        sigtrp_<section>. As in cdfsigtrp, sigma-0 is the EOS-80 one (as the
+        sigma-theta of the observed overflows), the depths of the class
+        limits are interpolated in each water column and the transport of
+        each cell is split between the classes
+
+Transports are in Sv, positive to the right of the section going from its
+first point to its last one. Sections are taken from their geometry index
+(section_index.py), so only the boxes around the sections are read.
+'''
+
+import os
+import argparse
+import numpy as np
+import netCDF4 as nc4
+from section_index import get_config, find_section_file, load_section_index, gather_section
+
+def load_argument():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", dest="ufile", metavar="U file", help="file of the zonal velocity", type=str, required=True)
+    parser.add_argument("-v", dest="vfile", metavar="V file", help="file of the meridional velocity", type=str, required=True)
+    parser.add_argument("-t", dest="tfile", metavar="T file", help="file of the potential temperature and practical salinity (for -sig)", type=str)
+    parser.add_argument("-temp", dest="temp", metavar="temperature", help="potential temperature variable (default thetao_pot)", type=str, default="thetao_pot")
+    parser.add_argument("-sal", dest="sal", metavar="salinity", help="practical salinity variable (default so_pra)", type=str, default="so_pra")
+    parser.add_argument("-m", dest="mesh", metavar="mesh file", help="mesh file (default mesh.nc)", type=str, default="mesh.nc")
+    parser.add_argument("-mask", dest="mask", metavar="mask file", help="file of umask and vmask if not in the mesh file (default mask.nc)", type=str, default="mask.nc")
+    parser.add_argument("-d", dest="sections_dir", metavar="sections directory", help="directory of the section files (default SECTIONS of the repository)", type=str,
+                        default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "SECTIONS"))
+    parser.add_argument("-s", dest="sections", metavar="sections", help="sections of the net, positive and negative transports", type=str, nargs="+", default=[])
+    parser.add_argument("-b", dest="bottom", metavar="sections", help="sections of the transports of the bottom velocity", type=str, nargs="+", default=[])
+    parser.add_argument("-sig", dest="sigma", metavar="sections", help="sections of the transports in sigma-0 classes", type=str, nargs="+", default=[])
+    parser.add_argument("-smin", dest="smin", metavar="sigma min", help="lower sigma-0 limit of the classes (default 27.8)", type=float, default=27.8)
+    parser.add_argument("-smax", dest="smax", metavar="sigma max", help="upper sigma-0 limit of the classes (default 40.)", type=float, default=40.)
+    parser.add_argument("-nbins", dest="nbins", metavar="bins", help="number of sigma-0 classes (default 1)", type=int, default=1)
+    parser.add_argument("-vvl", dest="vvl", help="read the time varying thickness of the cells (thkcello) in the U and V files", action="store_true")
+    parser.add_argument("-sfx", dest="sfx", metavar="suffix", help="suffix of the transport files (<section>_<sfx>.nc)", type=str, required=True)
+    parser.add_argument("-xsec", dest="xsec", metavar="prefix", help="prefix of the sigma-0 transport files (<xsec><section>_trpsig.nc, default nemoXsec_)", type=str, default="nemoXsec_")
+    parser.add_argument("-c", dest="store", metavar="store", help="directory of the section index store (default $WEIGHTS_STORE)", type=str, default=os.environ.get("WEIGHTS_STORE"))
+    return parser.parse_args()
+
+def face_thickness(dsu, dsv, index, vvl):
+    '''
+    Thickness of the cells at the faces of a section, time x z x faces.
+    '''
+    if not vvl:
+        return index["e3"][None]
+    return gather_section(dsu["thkcello"], index, "u") + gather_section(dsv["thkcello"], index, "v")
+
+def section_transport(dsu, dsv, index, vvl, bottom=False):
+    '''
+    Transport of each cell of the faces of a section (Sv), positive to the
+    right of the section, time x z x faces. With bottom, the velocity of the
+    deepest ocean cell of each face is used over the whole water column.
+    '''
+    vel = gather_section((dsu["uo"], dsv["vo"]), index, "uv")
+    if bottom:
+        kbot = np.maximum(index["mask"].sum(axis=0).astype(int) - 1, 0)
+        vel = np.broadcast_to(vel[:, kbot, np.arange(vel.shape[-1])][:, None, :], vel.shape)
+    e3 = face_thickness(dsu, dsv, index, vvl)
+    return np.nan_to_num(vel * e3 * index["e_h"] * index["mask"]) / 1.e6
+
+def sigma0_eos80(ptemp, psal):
+    '''
+    Potential density anomaly referenced to the surface (kg/m3) from the
+    potential temperature and practical salinity, with the EOS-80 (UNESCO)
+    equation of state at the surface, as the sigma0 of CDFTOOLS.
+    '''
+    rho_w = ((((6.536332e-9*ptemp - 1.120083e-6)*ptemp + 1.001685e-4)*ptemp - 9.095290e-3)*ptemp + 6.793952e-2)*ptemp + 999.842594
+    coef_a = (((5.3875e-9*ptemp - 8.2467e-7)*ptemp + 7.6438e-5)*ptemp - 4.0899e-3)*ptemp + 0.824493
+    coef_b = (-1.6546e-6*ptemp + 1.0227e-4)*ptemp - 5.72466e-3
+    return (4.8314e-4*psal + coef_b*np.sqrt(np.abs(psal)) + coef_a)*psal + rho_w - 1000.
+
+def section_sigma0(dst, index, temp, sal):
+    '''
+    Potential density anomaly referenced to the surface (sigma0_eos80) at the
+    faces of a section, from the temperature and salinity averaged over the
+    T points on both sides (or the ocean one), as in cdf_xtrac_brokenline,
+    time x z x faces.
+    '''
+    sides = []
+    for name in (temp, sal):
+        values = gather_section(dst[name], index, "t") # time x z x 2 x faces
+        side1, side2 = values[..., 0, :], values[..., 1, :]
+        sides.append(np.where(np.isnan(side2), side1, np.where(np.isnan(side1), side2, 0.5*(side1 + side2))))
+    return sigma0_eos80(*sides)
+
+def isopycnal_depth(sigma, depth, bottom, limit):
+    '''
+    Depth of the limit isopycnal in each water column (time x faces), as in
+    cdfsigtrp: 0 if the top cell is denser, interpolated linearly between the
+    depths of the first two levels whose sigma brackets it, or the bottom if
+    no water of the column is as dense. sigma and depth are time x z x faces,
+    NaN below the bottom.
+    '''
+    cross = (limit - sigma[:, :-1])*(limit - sigma[:, 1:]) <= 0 # False next to NaN
+    k = np.argmax(cross, axis=1)[:, None] # first bracketing levels
+    s1, s2 = np.take_along_axis(sigma, k, axis=1)[:, 0], np.take_along_axis(sigma, k + 1, axis=1)[:, 0]
+    z1, z2 = np.take_along_axis(depth, k, axis=1)[:, 0], np.take_along_axis(depth, k + 1, axis=1)[:, 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alpha = np.where(s2 != s1, (limit - s1)/(s2 - s1), 0.)
+    hiso = np.where(cross.any(axis=1), z1 + alpha*(z2 - z1), bottom)
+    return np.where(limit <= sigma[:, 0], 0., hiso)
+
+def sigma_transport(trp, sigma, e3, bins):
+    '''
+    Transport in each sigma class (edges bins), time x classes, as in
+    cdfsigtrp: the transport of each cell (trp, time x z x faces) is split
+    between the classes by the fraction of its thickness (e3, 0 out of the
+    ocean) between the depths of their limits (isopycnal_depth), the sigma
+    of the cells being at their middle.
+    '''
+    e3 = np.broadcast_to(e3, trp.shape)
+    sigma = np.where(e3 > 0, sigma, np.nan)
+    top = np.cumsum(e3, axis=1) - e3 # depth of the top of the cells
+    hiso = [isopycnal_depth(sigma, np.where(e3 > 0, top + 0.5*e3, np.nan), e3.sum(axis=1), limit)[:, None] for limit in bins]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac = [np.where(e3 > 0, np.clip(np.minimum(top + e3, hiso[n + 1]) - np.maximum(top, hiso[n]), 0., None)/e3, 0.)
+                for n in range(len(bins) - 1)]
+    return np.stack([(trp*f).sum(axis=(1, 2)) for f in frac], axis=-1)
+
+def write_output(outfile, dsref, variables, sigma=None):
+    '''
+    Writes time series (name -> (values, long name)) with the time of dsref.
+    '''
+    tname = "time_centered" if "time_centered" in dsref.variables else "time_counter"
+    with nc4.Dataset(outfile, "w") as ds:
+        ds.createDimension("time_counter", None)
+        time = ds.createVariable("time_centered", "f8", ("time_counter",))
+        time.setncatts({k: dsref[tname].getncattr(k) for k in dsref[tname].ncattrs() if k in ("units", "calendar", "long_name")})
+        time[:] = dsref[tname][:]
+        dims = ("time_counter",)
+        if sigma is not None:
+            ds.createDimension("sigma", len(sigma))
+            sig = ds.createVariable("sigma", "f4", ("sigma",))
+            sig.long_name = "lower limit of the sigma-0 classes"
+            sig.units = "kg/m3"
+            sig[:] = sigma
+            dims = ("time_counter", "sigma")
+        for name, (values, long_name) in variables.items():
+            var = ds.createVariable(name, "f4", dims)
+            var.long_name = long_name
+            var.units = "Sv"
+            var[:] = values
+
+def main():
+    args = load_argument()
+    if args.sigma and not args.tfile:
+        raise Exception("A T file (-t) is required for the transports in sigma classes (-sig)")
+
+    mesh_files = [args.mesh] + ([args.mask] if os.path.exists(args.mask) and args.mask != args.mesh else [])
+    config = get_config(args.mesh)
+    index = lambda kind, name: load_section_index(mesh_files, find_section_file(args.sections_dir, kind, name, config), args.store)
+
+    dsu, dsv = nc4.Dataset(args.ufile), nc4.Dataset(args.vfile)
+    dst = nc4.Dataset(args.tfile) if args.sigma else None
+    try:
+        for section in args.sections:
+            sindex = index("LONLAT", section)
+            name = str(sindex["name"]) # outputs are named after the section file, as in cdftransport (e.g. Gibraltar)
+            trp = section_transport(dsu, dsv, sindex, args.vvl).reshape(dsv["vo"].shape[0], -1)
+            write_output(f"{name}_{args.sfx}.nc", dsv, {
+                "vtrp": (trp.sum(axis=-1), "Volume transport"),
+                "ptrp": (np.where(trp > 0, trp, 0).sum(axis=-1), "Positive volume transport"),
+                "mtrp": (np.where(trp < 0, trp, 0).sum(axis=-1), "Negative volume transport")})
+            print(f"{name}: {trp.sum(axis=-1).mean():.3f} Sv")
+
+        for section in args.bottom:
+            sindex = index("LONLAT", section)
+            name = str(sindex["name"])
+            trp = section_transport(dsu, dsv, sindex, args.vvl, bottom=True).reshape(dsv["vo"].shape[0], -1)
+            write_output(f"{name}_bottom_{args.sfx}.nc", dsv, {
+                "vtrp": (trp.sum(axis=-1), "Volume transport of the bottom velocity"),
+                "ptrp": (np.where(trp > 0, trp, 0).sum(axis=-1), "Positive volume transport of the bottom velocity"),
+                "mtrp": (np.where(trp < 0, trp, 0).sum(axis=-1), "Negative volume transport of the bottom velocity")})
+            print(f"{name} (bottom velocity): {trp.sum(axis=-1).mean():.3f} Sv")
+
+        bins = np.linspace(args.smin, args.smax, args.nbins + 1)
+        for section in args.sigma:
+            sindex = index("XTRAC", section)
+            name = str(sindex["name"])
+            e3 = np.nan_to_num(face_thickness(dsu, dsv, sindex, args.vvl)*sindex["mask"])
+            trp = sigma_transport(section_transport(dsu, dsv, sindex, args.vvl), section_sigma0(dst, sindex, args.temp, args.sal), e3, bins)
+            write_output(f"{args.xsec}{name}_trpsig.nc", dsv, {
+                f"sigtrp_{name}": (trp, f"Transport in sigma-0 classes through {name}")}, sigma=bins[:-1])
+            print(f"{name} (sigma-0 {args.smin}-{args.smax}): {trp.sum(axis=-1).mean():.3f} Sv")
+    finally:
+        for ds in (dsu, dsv, dst):
+            if ds is not None:
+                ds.close()
+
+
+if __name__=="__main__":
+    main()
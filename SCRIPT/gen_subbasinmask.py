@@ -1,92 +1,141 @@
+import os
 import xarray as xr # 2025.1.2
 import numpy as np # 2.2.3
 import argparse # 1.1
-from util import get_ij_from_lon_lat, get_poly_line_ij, floodfill
+from util import get_ij_from_lon_lat, get_poly_line_ij, label_regions, get_orca_topology
+from util import get_file_hash, get_cache_key, cache_lookup, link_cache_entry
+
+SUBBASIN_VERSION = 1 # version of the sub-basin generation, part of the cache key
+
+# Southern limit of the Atlantic, Indian and Pacific basins,
+# the Southern Ocean being the ocean south of it
+SO_LAT = -34.0
+
+# Barrier sections closing the basins, as (lon, lat) polylines
+# rasterised on the model grid. They should start and end on land.
+BARRIERS = {
+     "gibraltar": [(-6.1536, 37.6231), (-6.2156, 33.8010)],
+     "bering"   : [(-171.5, 66.3), (-164.5, 65.5)],
+     "indonesia": [(100.0, 10.0), (104.0, 1.0), (106.0, -6.0), (115.5, -8.5),
+                   (125.0, -9.5), (142.5, -10.5), (145.0, -15.0)],
+}
+
+# Basins north of SO_LAT, each one is the ocean connected to its seed
+# point once all the barriers are closed
+BASINS = {
+     "atlmsk": {"seed": (-38.2784, 36.3402)},
+     "indmsk": {"seed": (75.0, -10.0)},
+     "pacmsk": {"seed": (-150.0, 0.0)},
+}
 
 def load_argument():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-m", 
-                        "--mesh", 
-                        dest="mesh", 
-                        metavar="mesh file", 
-                        help="the mesh file to work from", 
-                        type=str, 
-                        nargs=1 , 
+    parser.add_argument("-m",
+                        "--mesh",
+                        dest="mesh",
+                        metavar="mesh file",
+                        help="the mesh file to work from",
+                        type=str,
+                        nargs=1 ,
                         required=True
     )
-    parser.add_argument("-o", 
-                        "--outf", 
-                        dest="outf", 
-                        metavar="output file", 
-                        help="name of output file", 
-                        type=str, 
-                        nargs=1, 
+    parser.add_argument("-o",
+                        "--outf",
+                        dest="outf",
+                        metavar="output file",
+                        help="name of output file",
+                        type=str,
+                        nargs=1,
                         required=True
     )
+    parser.add_argument("-c",
+                        "--cache",
+                        dest="cache",
+                        metavar="cache directory",
+                        help="directory of the mask cache, sub-basin masks are reused for identical meshes (default $TMASK_CACHE)",
+                        type=str,
+                        nargs=1,
+                        default=[os.environ.get("TMASK_CACHE", "")],
+                        required=False
+    )
     return parser.parse_args()
 
-def main():
-
-    args = load_argument()
-    mesh = xr.open_dataset(args.mesh[0]).squeeze()
+def gen_subbasins(mesh):
+    '''
+    Builds the global, Atlantic, Indian, Pacific and Southern Ocean
+    surface masks of a mesh. The ocean north of SO_LAT, without the
+    BARRIERS sections, is labelled once; each basin of BASINS is then
+    the region containing its seed point.
+    '''
     zdim = ""
     for k in ["nav_lev","z"]:
-        if k in mesh: 
+        if k in mesh or k in mesh.dims:
            zdim = k
            break
-    assert zdim != "", "Vertical dimension not found in " + args.mesh[0]
+    assert zdim != "", "Vertical dimension not found in mesh"
     tmsk = mesh['tmask'].isel({zdim : 0})
+    ocean = tmsk.values != 0
+    glamt = mesh.glamt.values
+    gphit = mesh.gphit.values
 
-    # Saving global mask
-    glomsk = tmsk.rename('glomsk')
-    
-
-    # Saving pacific, indian and southern oceans mask
-    # Since we don't use them, we put all of them to zero.
-    indmsk = pacmsk = somsk = tmsk.copy()*0
-    indmsk = indmsk.rename('indmsk')
-    pacmsk = pacmsk.rename('pacmsk')
-    somsk = somsk.rename('somsk')
-
-    # Creating mask for the Atlantic
-    # a) Closing the Med
-    atlmsk = tmsk.rename('atlmsk')
-    lon1 = -6.1536
-    lat1 = 37.6231
-    lon2 = -6.2156
-    lat2 = 33.8010
-    
-    j1, i1 = get_ij_from_lon_lat(lon1, 
-                                 lat1, 
-                                 mesh.glamt.values, 
-                                 mesh.gphit.values
-    )
-    j2, i2 = get_ij_from_lon_lat(lon2, 
-                                 lat2, 
-                                 mesh.glamt.values, 
-                                 mesh.gphit.values
+    # Resolving all the needed points in one batched query:
+    # the vertices of the barrier sections and the basin seeds
+    points = [pt for section in BARRIERS.values() for pt in section] + [basin["seed"] for basin in BASINS.values()]
+    J, I = get_ij_from_lon_lat([pt[0] for pt in points],
+                               [pt[1] for pt in points],
+                               glamt,
+                               gphit
     )
-    Js, Is = get_poly_line_ij([i1, i2], 
-                              [j1, j2]
-                             )
-    atlmsk[Js,Is] = 0
-    # b) Only the Atlantic northern than 34.0 South
-    atlmsk = atlmsk.where(mesh.gphit>=-34.0,0)
-    jstart, istart = get_ij_from_lon_lat(-38.2784, 
-                                          36.3402, 
-                                          mesh.glamt.values, 
-                                          mesh.gphit.values
-    )
-    wrk = floodfill(atlmsk,
-                    jstart,
-                    istart,
-                    0,
-                    2
-    )
-    atlmsk = atlmsk.where(wrk==2,0)
 
-    xr.merge([glomsk, atlmsk, indmsk, pacmsk, somsk]).to_netcdf(args.outf[0])
-    
+    # Closing the barriers
+    open_ocean = ocean & (gphit >= SO_LAT)
+    n = 0
+    for section in BARRIERS.values():
+        Js, Is = get_poly_line_ij(I[n:n + len(section)],
+                                  J[n:n + len(section)]
+                                 )
+        open_ocean[Js, Is] = False
+        n += len(section)
+
+    cyclic, nfold = get_orca_topology(mesh, cyclic=True) # the basins are global
+    labels, _ = label_regions(open_ocean, cyclic=cyclic, nfold=nfold)
+
+    seeds = {name: labels[jseed, iseed] for name, jseed, iseed in zip(BASINS, J[n:], I[n:])}
+    for name, seed in seeds.items():
+        assert seed > 0, f"Seed point of {name} is not in the open ocean"
+    assert len(set(seeds.values())) == len(seeds), "Some basins are connected, check BARRIERS"
+
+    masks = {"glomsk": ocean}
+    masks.update({name: labels == seed for name, seed in seeds.items()})
+    masks["somsk"] = ocean & (gphit < SO_LAT)
+
+    return [tmsk.copy(data=msk.astype(tmsk.dtype)).rename(name) for name, msk in masks.items()]
+
+def main():
+
+    args = load_argument()
+    cache_dir = args.cache[0]
+
+    if cache_dir:
+       os.makedirs(cache_dir, exist_ok=True)
+       key = get_cache_key(get_file_hash(args.mesh[0], cache_dir), "subbasins", SUBBASIN_VERSION, SO_LAT, BARRIERS, BASINS)
+       entry, hit = cache_lookup(cache_dir, "subbasins_" + key) # prefixed, not pruned with the tmasks (gen_tmasks.py)
+       if hit:
+          print(f"Sub-basin masks found in cache: {entry}")
+          link_cache_entry(entry, args.outf[0])
+          return
+
+    mesh = xr.open_dataset(args.mesh[0]).squeeze()
+    subbasins = xr.merge(gen_subbasins(mesh))
+
+    if cache_dir:
+       tmp_file = f"{entry}.{os.getpid()}.tmp"
+       subbasins.to_netcdf(tmp_file)
+       os.replace(tmp_file, entry)
+       link_cache_entry(entry, args.outf[0])
+    else:
+       subbasins.to_netcdf(args.outf[0])
+
 
 if __name__=="__main__":
-    main() 
+    main()
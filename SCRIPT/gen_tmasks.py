@@ -6,8 +6,17 @@ Routine to generate tmask files for processes defined
 import argparse
 import subprocess
 import os
+import io
+import sys
+import glob
 import time
 import json
+import contextlib
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import tmask_zoom
+from util import write_tmask, get_file_hash, get_cache_key, cache_lookup, link_cache_entry, prune_cache
 
 def source_param(param_file_path):
     """Source a bash script and return all variables with the prefix 'run'."""
@@ -36,8 +45,26 @@ def domain_params(domain_name):
 def load_argument():
     parser = argparse.ArgumentParser()
     parser.add_argument("-r", dest="runid", metavar="runid", type=str, nargs=1, required=True)
+    parser.add_argument("-n", dest="nworkers", metavar="number of workers", help="number of tmasks generated concurrently", type=int, nargs=1, default=[int(os.environ.get('SLURM_CPUS_PER_TASK', 1))], required=False)
     return parser.parse_args()
 
+TMASK_PREFIX = 'tmask_' # prefix of the tmask entries of the cache, the only ones pruned here as other tools share the cache
+MESH_DATA = {} # mesh path -> mesh variables loaded once, shared read-only with the forked workers
+
+def run_tmask(tmask_fname, mesh, param_list):
+    """Generate one tmask from the shared mesh data; return the log, the elapsed time and whether it succeeded."""
+    log = io.StringIO()
+    start_time = time.time()
+    success = False
+    with contextlib.redirect_stdout(log):
+        try:
+            tmask_args = tmask_zoom.load_argument(param_list)
+            write_tmask(tmask_zoom.gen_tmask(MESH_DATA[mesh], tmask_args), tmask_args.outf[0], fmt=tmask_args.fmt)
+            success = True
+        except (Exception, SystemExit):
+            print(traceback.format_exc())
+    return tmask_fname, log.getvalue(), time.time() - start_time, success
+
 args = load_argument()
 
 processes = source_param(os.path.join(os.environ['MARINE_VAL'],'param.bash')) # load run environment variables
@@ -74,6 +101,8 @@ domains = {
       "WWED": {"W": -65.130, "E": -53.020, "S": -75.950, "N": -72.340, "tlon": -59, "tlat": -74}
 }
 
+# tmasks are written in the compact format of util.write_tmask unless "fmt": "full" is set
+# (global masks, needed by the CDFTOOLS of HTC and STC)
 proc_tmask_map = {
      "runAABW": [{**domain_params("WEDATL"), "mindepth": 1500, "maxdepth": None, "obs": None}, 
                  {**domain_params("SOUTHERN_OCEAN"), "mindepth": 1500, "maxdepth": None, "obs": None}],
@@ -81,8 +110,8 @@ proc_tmask_map = {
                    {**domain_params("WROSS"), "mindepth": 390, "maxdepth": None, "obs": None}, 
                    {**domain_params("EROSS"), "mindepth": 390, "maxdepth": None, "obs": None},
                    {**domain_params("WWED"), "mindepth": 390, "maxdepth": None, "obs": None}],
-     "runHTC": [{**domain_params("NA_GYRE"), "minisobath": 1000, "maxisobath": None, "obs": None},
-                {**domain_params("NA_GYRE"), "minisobath": 1000, "maxisobath": None, "obs": 'woa13v2'}],
+     "runHTC": [{**domain_params("NA_GYRE"), "minisobath": 1000, "maxisobath": None, "obs": None, "fmt": "full"},
+                {**domain_params("NA_GYRE"), "minisobath": 1000, "maxisobath": None, "obs": 'woa13v2', "fmt": "full"}],
      "runMedOVF": [{**domain_params("MEDOVF"), "mindepth": 500, "maxdepth": 2500, "obs": None}, 
                    {**domain_params("MEDOVF"), "mindepth": 500, "maxdepth": 2500, "obs": 'woa13v2'}], 
      "runMLD_LabSea": [{**domain_params("LAB_SEA"), "minisobath": 1000, "maxisobath": None, "obs": None}],
@@ -93,8 +122,8 @@ proc_tmask_map = {
      "runSSS_LabSea": [{**domain_params("LAB_SEA"), "mindepth": None, "maxdepth": 1.5, "obs": None}],
      "runSST_NWCorner": [{**domain_params("NEWFOUND"), "mindepth": None, "maxdepth": 1.5, "obs": None}],
      "runSST_SO": [{**domain_params("SO"), "mindepth": None, "maxdepth": 1.5, "obs": None}],
-     "runSTC": [{**domain_params("NA_GYRE"), "minisobath": 1000, "maxisobath": None, "obs": None},
-                {**domain_params("NA_GYRE"), "minisobath": 1000, "maxisobath": None, "obs": 'woa13v2'}],
+     "runSTC": [{**domain_params("NA_GYRE"), "minisobath": 1000, "maxisobath": None, "obs": None, "fmt": "full"},
+                {**domain_params("NA_GYRE"), "minisobath": 1000, "maxisobath": None, "obs": 'woa13v2', "fmt": "full"}],
 }
 
 #########################################################################################################################################
@@ -103,7 +132,8 @@ proc_tmask_map = {
 
 all_tmask_params = {}
 tmasks_generated = {}
-naming_params_order = ('obs', 'mindepth', 'minisobath', 'maxdepth', 'maxisobath')
+tmask_jobs = {} # tmask file name -> (mesh, parameters), each tmask is generated only once
+naming_params_order = ('obs', 'mindepth', 'minisobath', 'maxdepth', 'maxisobath', 'fmt')
 
 for proc, tmask_list in proc_tmask_map.items():
      proc_tmasks_generated = []
@@ -121,24 +151,80 @@ for proc, tmask_list in proc_tmask_map.items():
           params['m'] = mesh
           param_str = ' '.join(f"-{k} {v}" for k, v in params.items())
           all_tmask_params[tmask_fname] = params # Update all params to save later
-          # Generate tmask 
+          # Queue tmask generation
           if proc in processes.keys() and int(processes[proc]) == 1:
-               print(f"Generating {tmask_fname} ...")
+               print(f"Queuing {tmask_fname} ...")
                print(f"param_string: {param_str}")
                proc_tmasks_generated.append(tmask_fname)
-               start_time = time.time()
-               jobout = subprocess.run(["python", os.path.join(os.environ["SCRPATH"], "tmask_zoom.py"), *param_str.split()], capture_output=True, text=True)
-               elapsed = time.time() - start_time
-               print(jobout.stdout)
-               if jobout.stderr:
-                   print(jobout.stderr)
-               print(f"{tmask_fname} generated in {elapsed:.2f} seconds.\n")
+               tmask_jobs[tmask_fname] = (mesh, params)
           elif proc not in processes.keys():
                print(f"{proc} not found in param.bash\n")
      # Store generated tmasks for each process
      if proc_tmasks_generated:               
           tmasks_generated[proc]= proc_tmasks_generated
 
+# Content-addressed tmask cache shared across RUNIDs: the key of a tmask is the hash of the
+# mesh file and of its parameters, hits are symlinked into the run directory
+cache_dir = os.environ.get('TMASK_CACHE', '')
+cache_entries = {} # tmask file name -> cache entry to generate
+if cache_dir and tmask_jobs:
+     os.makedirs(cache_dir, exist_ok=True)
+     mesh_hashes = {mesh: get_file_hash(mesh, cache_dir) for mesh in set(mesh for mesh, _ in tmask_jobs.values())}
+     for tmask_fname, (mesh, params) in list(tmask_jobs.items()):
+          key_params = {k: v for k, v in params.items() if k not in ('o', 'm')}
+          entry, hit = cache_lookup(cache_dir, TMASK_PREFIX + get_cache_key(mesh_hashes[mesh], tmask_zoom.TMASK_VERSION, key_params))
+          if hit:
+               print(f"{tmask_fname} found in cache: {entry}")
+               link_cache_entry(entry, params['o'])
+               del tmask_jobs[tmask_fname]
+          else:
+               cache_entries[tmask_fname] = entry
+
+# Load each mesh once, then generate all tmasks concurrently in forked workers sharing the mesh data
+for mesh in sorted(set(mesh for mesh, _ in tmask_jobs.values())):
+     start_time = time.time()
+     MESH_DATA[mesh] = tmask_zoom.load_mesh(mesh)
+     print(f"{mesh} loaded in {time.time() - start_time:.2f} seconds.")
+
+nworkers = max(1, min(args.nworkers[0], len(tmask_jobs)))
+print(f"\nGenerating {len(tmask_jobs)} tmasks with {nworkers} workers ...\n")
+start_time = time.time()
+failed = [] # tmasks whose generation raised or wrote no file
+if tmask_jobs:
+     with ProcessPoolExecutor(max_workers=nworkers, mp_context=multiprocessing.get_context('fork')) as executor:
+          jobs = []
+          for tmask_fname, (mesh, params) in tmask_jobs.items():
+               if tmask_fname in cache_entries: # written to a temporary file of the cache, moved in place once complete
+                    params = {**params, 'o': f"{cache_entries[tmask_fname]}.{os.getpid()}.tmp"}
+               param_list = ' '.join(f"-{k} {v}" for k, v in params.items()).split()
+               jobs.append(executor.submit(run_tmask, tmask_fname, mesh, param_list))
+          for job in as_completed(jobs):
+               tmask_fname, log, elapsed, success = job.result()
+               print(log)
+               outfile = tmask_jobs[tmask_fname][1]['o']
+               if tmask_fname in cache_entries:
+                    entry = cache_entries[tmask_fname]
+                    tmp_file = f"{entry}.{os.getpid()}.tmp"
+                    if success and os.path.exists(tmp_file):
+                         os.replace(tmp_file, entry)
+                         link_cache_entry(entry, outfile)
+                    elif os.path.exists(tmp_file):
+                         os.remove(tmp_file)
+               if not success or not os.path.exists(outfile):
+                    print(f"E R R O R: {tmask_fname} failed, see the error above.\n")
+                    failed.append(tmask_fname)
+                    continue
+               print(f"{tmask_fname} generated in {elapsed:.2f} seconds.\n")
+print(f"All tmasks generated in {time.time() - start_time:.2f} seconds.\n")
+
+if cache_dir:
+     # entries linked from the run directory of any RUNID are kept, their mk_* jobs may still be queued
+     in_use = [params['o'] for params in all_tmask_params.values() if os.path.islink(params['o'])]
+     run_dirs = [d for d in glob.glob(os.path.join(os.environ['DATPATH'], '*', '')) if os.path.realpath(d) != os.path.realpath(cache_dir)]
+     for removed in prune_cache(cache_dir, float(os.environ.get('TMASK_CACHE_SIZE', 10)) * 1024**3, keep=in_use,
+                                prefix=TMASK_PREFIX, link_dirs=run_dirs):
+          print(f"Removed {removed} from the tmask cache (least recently used).")
+
 print("All tmasks parameters:")
 for tmask_name, params in all_tmask_params.items():
      print(f"{tmask_name}: {params}")
@@ -150,3 +236,7 @@ with open(os.path.join(os.environ["SCRPATH"], "tmasks_all_params.json"), "w") as
 
 with open(os.path.join(os.environ["SCRPATH"], "tmasks_generated.json"), "w") as f:
     json.dump(tmasks_generated, f, indent=2)
+
+if failed:
+    print(f"\n{len(failed)} tmasks failed: {' '.join(sorted(failed))}")
+    sys.exit(1)
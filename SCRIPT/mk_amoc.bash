@@ -1,7 +1,8 @@
 #!/bin/bash
-#SBATCH --mem=150G
+#SBATCH --mem=20G
 #SBATCH --time=360
 #SBATCH --ntasks=1
+#SBATCH --cpus-per-task=8
 
 if [[ $# -ne 3 ]]; then echo 'mk_moc.bash [RUNID (mi-aa000)] [TAG (19991201_20061201_ANN)] [FREQ (1y)]'; exit 1 ; fi
 
@@ -37,6 +38,7 @@ if [[ "$runVRMP" == 1 ]]; then
    if [[ ! -L mask.nc   ]] ; then ln -s $DATPATH/$RUNID/vrmp/zgr_amoc.nc mask.nc    ; fi
    if [[ ! -L bathy.nc  ]] ; then ln -s $DATPATH/$RUNID/vrmp/bathy_amoc.nc bathy.nc ; fi
    if [[ ! -L subbasinmask_amoc.nc ]] ; then ln -s ../vrmp/subbasinmask_amoc.nc . ; fi
+   MESHH=mesh_h.nc ; MESHZ=mesh_z.nc
 else
    cp $DATPATH/$RUNID/nam_cdf_names .
    FILEU=`ls $DATPATH/$RUNID/[nu]*${RUN_NAME}o_${FREQ}_${TAG}*_grid[-_]U.nc`
@@ -47,6 +49,7 @@ else
    if [[ ! -L mask.nc   ]] ; then ln -s $DATPATH/$RUNID/mask.nc  . ; fi
    if [[ ! -L bathy.nc  ]] ; then ln -s $DATPATH/$RUNID/bathy.nc . ; fi
    if [[ ! -L subbasinmask_amoc.nc ]] ; then ln -s $DATPATH/$RUNID/subbasinmask_amoc.nc . ; fi
+   MESHH=mesh.nc ; MESHZ=mesh.nc
 fi
 
 if [ ! -f $FILEU ] ; then echo "$FILEU is missing; exit"; echo "E R R O R in : ./mk_moc.bash $@ (see SLURM/${RUNID}/mk_moc_${FREQ}_${TAG}.out)" >> ${EXEPATH}/ERROR.txt ; exit 1 ; fi
@@ -57,11 +60,11 @@ if [ ! -f $FILES ] ; then echo "$FILES is missing; exit"; echo "E R R O R in : .
 # b) Compute AMOC streamfunction in depth space
 
 FILEOUT=nemo_${RUN_NAME}o_${FREQ}_${TAG}.nc
-$CDFPATH/cdfmoc -v $FILEV -o tmp_$FILEOUT
-if [[ $? -eq 99 || $? -eq 0 ]]; then 
+python ${SCRPATH}/calc_moc_zonint.py -v $FILEV -mh $MESHH -mz $MESHZ -o tmp_$FILEOUT
+if [[ $? -eq 0 ]]; then 
    mv tmp_$FILEOUT AMOC_depth_$FILEOUT
 else 
-   echo "error when running cdfmoc; exit"; echo "E R R O R in : ./mk_moc.bash $@ (see SLURM/${RUNID}/mk_moc_${FREQ}_${TAG}.out)" >> ${EXEPATH}/ERROR.txt ; exit 1
+   echo "error when running calc_moc_zonint.py; exit"; echo "E R R O R in : ./mk_moc.bash $@ (see SLURM/${RUNID}/mk_moc_${FREQ}_${TAG}.out)" >> ${EXEPATH}/ERROR.txt ; exit 1
 fi
 
 echo "AMOC streamfunction in depth space done!"
@@ -103,11 +106,11 @@ if [ ! -f $FILET ] ; then echo "$FILET is missing; exit"; echo "E R R O R in : .
 if [ ! -f $FILES ] ; then echo "$FILES is missing; exit"; echo "E R R O R in : ./mk_moc.bash $@ (see SLURM/${RUNID}/mk_moc_${FREQ}_${TAG}.out)" >> ${EXEPATH}/ERROR.txt ; exit 1 ; fi
 
 FILEOUT=nemo_${RUN_NAME}o_${FREQ}_${TAG}.nc
-$CDFPATH/cdfmocsig -v $FILEV -t $FILET -s $FILES -r 2000 $vvl -o tmp_$FILEOUT
-if [[ $? -eq 99 || $? -eq 0 ]]; then
+python ${SCRPATH}/calc_moc_zonint.py -v $FILEV -t $FILET $vvl -o tmp_$FILEOUT
+if [[ $? -eq 0 ]]; then
    mv tmp_$FILEOUT AMOC_sigma2_$FILEOUT
 else
-   echo "error when running cdfmocsig; exit"; echo "E R R O R in : ./mk_moc.bash $@ (see SLURM/${RUNID}/mk_moc_${FREQ}_${TAG}.out)" >> ${EXEPATH}/ERROR.txt ; exit 1
+   echo "error when running calc_moc_zonint.py; exit"; echo "E R R O R in : ./mk_moc.bash $@ (see SLURM/${RUNID}/mk_moc_${FREQ}_${TAG}.out)" >> ${EXEPATH}/ERROR.txt ; exit 1
 fi
 
 echo "AMOC streamfunction in sigm_2000 space done!"
@@ -25,6 +25,7 @@ done
 shift `expr $OPTIND - 1`
 
 if [[ -z "$areas" ]]; then areas="AMU WROSS EROSS WWED"; fi
+areas=${areas//,/ } # comma separated list of areas
 print "mk_deepTS.bash: processing areas $areas" 
 
 if [[ $# -ne 3 ]]; then echo 'mk_deepTS.bash -A [list of areas] [RUNID (mi-aa000)] [TAG (19991201_20061201_ANN)] [FREQ (1y)]'; exit 1 ; fi
@@ -46,8 +47,11 @@ RUN_NAME=${RUNID#*-}
 FILE=`ls [nu]*${RUN_NAME}o_${FREQ}_${TAG}*_grid[-_]${GRID}.nc`
 if [ ! -f $FILE ] ; then echo "$FILE is missing; exit"; echo "E R R O R in : ./mk_deepTS.bash $@ (see SLURM/${RUNID}/mk_deepTS_${TAG}.out)" >> ${EXEPATH}/ERROR.txt ; exit 1 ; fi
 
-# mean over relevant boxes
+# mean over relevant boxes, all the areas are reduced in one reduce_fields.py
+# call: each variable is read once for all the areas using it
 FILEOUT=nemo_${RUN_NAME}o_${FREQ}_${TAG}_deepTS.nc
+MANIFEST=deepTS_${FREQ}_${TAG}_manifest.json
+echo "[]" > $MANIFEST
 
 for area in $areas
 do
@@ -67,30 +71,36 @@ if [[ "$area" == "AMU" ]]
 then
 
 echo mk_deepTS.bash: calculating AMU thetao
-$SCRPATH/reduce_fields.py -i $FILE -v thetao_pot -c longitude latitude depth -A mean -G self mesh.nc mesh.nc -g cell_thickness e1t e2t \
-	       -o AMU_thetao_$FILEOUT -m $TMASK
+VAR=thetao_pot ; OUT=AMU_thetao_$FILEOUT
     
 elif [[ "$area" == "WROSS" ]]
 then
 
 echo mk_deepTS.bash: calculating WROSS so_pra
-$SCRPATH/reduce_fields.py -i $FILE -v so_pra -c longitude latitude depth -A mean -G self mesh.nc mesh.nc -g cell_thickness e1t e2t \
-	      -o WROSS_so_$FILEOUT -m $TMASK
+VAR=so_pra ; OUT=WROSS_so_$FILEOUT
 
 elif [[ "$area" == "EROSS" ]]
 then
 
 echo mk_deepTS.bash: calculating EROSS thetao
-$SCRPATH/reduce_fields.py -i $FILE -v thetao_pot -c longitude latitude depth -A mean -G self mesh.nc mesh.nc -g cell_thickness e1t e2t \
-	       -o EROSS_thetao_$FILEOUT -m $TMASK
+VAR=thetao_pot ; OUT=EROSS_thetao_$FILEOUT
 
 elif [[ "$area" == "WWED" ]]
 then
 
 echo mk_deepTS.bash: calculating WED so_pra 
-$SCRPATH/reduce_fields.py -i $FILE -v so_pra -c longitude latitude depth -A mean -G self mesh.nc mesh.nc -g cell_thickness e1t e2t \
-	      -o WED_so_$FILEOUT -m $TMASK
+VAR=so_pra ; OUT=WED_so_$FILEOUT
 
+else
+continue
 fi
+
+# add the area to the reduction of its variable
+jq --arg file "$FILE" --arg var "$VAR" --arg out "$OUT" --arg tmask "$TMASK" \
+   'if any(.[]; .invars == [$var]) then map(if .invars == [$var] then .outfile += [$out] | .tmask += [$tmask] else . end)
+    else . += [{infile: $file, invars: [$var], coords: ["longitude", "latitude", "depth"], aggr: "mean",
+                wgtsfiles: ["self", "mesh.nc", "mesh.nc"], wgtsnames: ["cell_thickness", "e1t", "e2t"],
+                outfile: [$out], tmask: [$tmask]}] end' $MANIFEST > tmp_$MANIFEST && mv tmp_$MANIFEST $MANIFEST
 done
 
+$SCRPATH/reduce_fields.py -B $MANIFEST
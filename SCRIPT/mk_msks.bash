@@ -2,9 +2,18 @@
 #SBATCH --mem=30G
 #SBATCH --time=20
 #SBATCH --ntasks=1
+#SBATCH --cpus-per-task=4
 
 if [[ $# -ne 1 ]]; then echo 'mk_msk_and_obs.bash [RUNID (mi-aa000)]'; exit 1 ; fi 
 
 RUNID=$1
 
-python ${SCRPATH}/gen_tmasks.py -r $RUNID 
+python ${SCRPATH}/gen_tmasks.py -r $RUNID -n ${SLURM_CPUS_PER_TASK:-1}
+if [[ $? -ne 0 ]]; then
+   echo "error when running gen_tmasks.py; exit" ; echo "E R R O R in : ./mk_msks.bash $@ (see SLURM/${RUNID}/mk_msks.out)" >> ${EXEPATH}/ERROR.txt ; exit 1
+fi
+
+# section geometry indexes, built once per mesh in the store
+if [[ -n "$WEIGHTS_STORE" ]]; then
+   python ${SCRPATH}/section_index.py -m ${DATPATH}/${RUNID}/mesh.nc -mask ${DATPATH}/${RUNID}/mask.nc -d ${EXEPATH}/SECTIONS
+fi
@@ -44,8 +44,7 @@ for GEN_TMASK in "${GENERATED_TMASKS[@]}"; do
 done
 echo WG TMASK: $TMASK
 
-# WG max
-$SCRPATH/reduce_fields.py -i $FILEOUT -v sobarstf -c longitude latitude -A max -o WG_$FILEOUT -m $TMASK
+TMASK_WG=$TMASK
 
 # Extract RG tmask filename
 PATTERN="RG"
@@ -57,6 +56,7 @@ for GEN_TMASK in "${GENERATED_TMASKS[@]}"; do
 done
 echo RG TMASK: $TMASK
 
-# RG max
-$SCRPATH/reduce_fields.py -i $FILEOUT -v sobarstf -c longitude latitude -A max -o RG_$FILEOUT -m $TMASK
+TMASK_RG=$TMASK
 
+# WG and RG max, from a single read of psi
+$SCRPATH/reduce_fields.py -i $FILEOUT -v sobarstf -c longitude latitude -A max -o WG_$FILEOUT RG_$FILEOUT -m $TMASK_WG $TMASK_RG
@@ -0,0 +1,53 @@
+#!/bin/bash
+#SBATCH --mem=8G
+#SBATCH --time=10
+#SBATCH --ntasks=1
+
+# transports through all the sections of a TAG in one job, with the outputs of mk_trp.bash for each section
+bottom=""
+while getopts S:A: opt
+   do
+   case $opt in
+      S) sections=${OPTARG//,/ } ;;
+      A) bottom=${OPTARG//,/ } ;;
+   esac
+done
+shift `expr $OPTIND - 1`
+
+if [[ -z "$sections" || $# -ne 3 ]]; then echo 'mk_trps.bash -S [sections (GibraltarStrait,BeringStrait,...)] [-A sections of the bottom transport (ACC)] [RUNID (mi-aa000)] [TAG (19991201_20061201_ANN)] [FREQ (1y)]'; exit 1 ; fi
+
+RUNID=$1
+TAG=$2
+FREQ=$3
+
+# overflows are defined by a cutoff density (sigma0) across their XTRAC section, as in mk_trp.bash
+trp_sections=""
+sig_sections=""
+for section in $sections; do
+   if [[ ${section} == "DenmarkStrait" || ${section} == "FaroeBankChannel" ]]; then
+      sig_sections="$sig_sections $section"
+   else
+      trp_sections="$trp_sections $section"
+   fi
+done
+dens_cutoff=27.8
+
+echo "TAG, sections, bottom : $TAG $sections $bottom"
+
+# name
+RUN_NAME=${RUNID#*-}
+
+# check presence of input file
+FILEV=`ls [nu]*${RUN_NAME}o_${FREQ}_${TAG}*_grid[-_]V.nc`
+FILEU=`ls [nu]*${RUN_NAME}o_${FREQ}_${TAG}*_grid[-_]U.nc`
+FILET=`ls [nu]*${RUN_NAME}o_${FREQ}_${TAG}*_grid[-_]T.nc`
+if [ ! -f $FILEV ] ; then echo "$FILEV is missing; exit"; echo "E R R O R in : ./mk_trps.bash $@ (see SLURM/${RUNID}/mk_trps_${FREQ}_${TAG}.out)" >> ${EXEPATH}/ERROR.txt ; exit 1 ; fi
+if [ ! -f $FILEU ] ; then echo "$FILEU is missing; exit"; echo "E R R O R in : ./mk_trps.bash $@ (see SLURM/${RUNID}/mk_trps_${FREQ}_${TAG}.out)" >> ${EXEPATH}/ERROR.txt ; exit 1 ; fi
+if [ ! -f $FILET ] ; then echo "$FILET is missing; exit"; echo "E R R O R in : ./mk_trps.bash $@ (see SLURM/${RUNID}/mk_trps_${FREQ}_${TAG}.out)" >> ${EXEPATH}/ERROR.txt ; exit 1 ; fi
+
+python ${SCRPATH}/calc_transports.py -u $FILEU -v $FILEV -t $FILET -vvl -d ${EXEPATH}/SECTIONS \
+       ${trp_sections:+-s $trp_sections} ${bottom:+-b $bottom} ${sig_sections:+-sig $sig_sections} -smin ${dens_cutoff} -smax 40.0 -nbins 1 \
+       -sfx nemo_${RUN_NAME}o_${FREQ}_${TAG} -xsec nemoXsec_${RUN_NAME}o_${FREQ}_${TAG}_
+if [[ $? -ne 0 ]]; then
+   echo "error when running calc_transports.py; exit" ; echo "E R R O R in : ./mk_trps.bash $@ (see SLURM/${RUNID}/mk_trps_${FREQ}_${TAG}.out)" >> ${EXEPATH}/ERROR.txt ; exit 1
+fi
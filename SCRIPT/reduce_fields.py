@@ -7,18 +7,50 @@ Wrapper to make it easy to call cube.collapsed from the command line.
 @date: March 2025
 '''
 
+import os
+import sys
+
+# Reductions are sent to the resident worker if one is listening on
+# $REDUCE_SOCKET (see reduce_worker.py), before the expensive imports
+if __name__=="__main__" and os.environ.get("REDUCE_SOCKET"):
+    from reduce_worker import submit
+    status = submit(os.environ["REDUCE_SOCKET"], sys.argv[1:])
+    if status is not None:
+        sys.exit(status)
+
+import json
+import functools
 import iris
 import iris.analysis
 import iris.util
 import numpy as np
 import numpy.ma as ma
+import dask.array as da
+from util import read_tmask, expand_tmask, get_region_index, read_box, union_box, region_stats
+from util import get_file_hash, get_cache_key, store_array, store_value
+
+CHUNK_SIZE = 256 # default size of the chunks of the reductions, in MiB
+
+def cached(cache,key,load):
+    '''
+    Return cache[key], filling it with load() first if needed.
+    Nothing is cached if cache is None.
+    '''
+    if cache is None:
+        return load()
+    if key not in cache:
+        cache[key] = load()
+    return cache[key]
 
-def read_cube(filename,fieldname):
+def read_cube(filename,fieldname,cache=None):
     '''
     Read a variable from a netcdf file as an Iris cube.
     Try to match name to standard_name, long_name or var_name
     Remove duplicate time dimension if necessary.
+    Cubes are read once per cache (see reduce_batch).
     '''
+    if cache is not None:
+        return cached(cache,("cube",filename,fieldname),lambda: read_cube(filename,fieldname))
 
     constraints = [ iris.NameConstraint(standard_name=fieldname),
                     iris.NameConstraint(long_name=fieldname),
@@ -46,12 +78,13 @@ def read_cube(filename,fieldname):
 
     return cube
 
-def get_weights(wgtsfile,wgtsname,cube):
+def get_weights(wgtsfile,wgtsname,cube,lazy=False,cache=None):
     '''
     Try to read in a weights field from the specified file, or if the 
     file is specified as "measures", try to read the weights field as
     a CellMeasure of the supplied cube. Weights get returned as masked
-    numpy arrays.
+    numpy arrays, or as lazy arrays if lazy is True.
+    Weights read from files are read once per cache (see reduce_batch).
     '''
 
     if wgtsfile == "measures":
@@ -66,69 +99,343 @@ def get_weights(wgtsfile,wgtsname,cube):
             raise Exception("Could not find "+wgtsname+" in cell measures of "+cube.var_name)
     else:
         print("Reading weights "+wgtsname+" as iris cube data.")
-        wgts = read_cube(wgtsfile,wgtsname).data[:]
+        wgts = read_cube(wgtsfile,wgtsname,cache=cache)
+        wgts = wgts.core_data() if lazy else cached(cache,("weights",wgtsfile,wgtsname),lambda: wgts.data[:])
     
     return wgts
 
-def reduce_fields(infile,tmask,invars=None,coords=None,wgtsfiles=None,wgtsnames=None,
-                  aggr=None,outfile=None,subout=None,surface=None):
+def get_depth_coord(cube):
+    '''
+    Return the depth coordinate of a cube (deptht, depthu or depthv), or None.
+    '''
+    return next(
+        (coord for coord in (list(cube.dim_coords) + list(cube.aux_coords))
+         if coord.var_name in ("deptht", "depthu", "depthv")),
+        None
+    )
 
-    aggregators = { "mean"     :  iris.analysis.MEAN ,
-                    "min"      :  iris.analysis.MIN  ,
-                    "max"      :  iris.analysis.MAX    }
+def get_aggregator(stat):
+    '''
+    Return the iris aggregator of a statistic and its keywords. Statistics are
+    mean, std, var, min, max, minloc, maxloc (min/max with their location)
+    and pNN (NN-th percentile, e.g. p90).
+    '''
+    aggregators = { "mean"     :  iris.analysis.MEAN     ,
+                    "std"      :  iris.analysis.STD_DEV  ,
+                    "var"      :  iris.analysis.VARIANCE ,
+                    "min"      :  iris.analysis.MIN      ,
+                    "max"      :  iris.analysis.MAX      ,
+                    "minloc"   :  iris.analysis.MIN      ,
+                    "maxloc"   :  iris.analysis.MAX        }
 
-    if infile is None:
-        raise Exception("Error: must specify input file")
+    if stat in aggregators:
+        return aggregators[stat], {}
+    if stat.startswith("p"):
+        try:
+            return iris.analysis.PERCENTILE, {"percent": float(stat[1:])}
+        except ValueError:
+            pass
+    raise Exception("Unknown statistic "+stat+", must be one of "+", ".join(aggregators)+" or pNN (percentile)")
 
-    if aggr is None:
-        aggr="mean"
+def add_location_coords(cube_reduced,cube,stat,points):
+    '''
+    Add to a cube reduced with minloc or maxloc the longitude, latitude and
+    depth of the min/max as auxiliary coordinates, points being the global
+    grid indices of the min/max (one array per grid dimension of cube, -1
+    where there is no valid point).
+    '''
+    ngrid = len(points)
+    first_grid_dim = cube.ndim - ngrid
+    found = points[0] >= 0
+    location_coords = [coord for coord in cube.coords() if coord.name() in ("longitude", "latitude") or coord is get_depth_coord(cube)]
+    for coord in location_coords:
+        dims = cube.coord_dims(coord)
+        if not dims or min(dims) < first_grid_dim:
+            continue
+        values = coord.points[tuple(points[dim - first_grid_dim].clip(0) for dim in dims)]
+        cube_reduced.add_aux_coord(iris.coords.AuxCoord(np.where(found, values, np.nan).reshape(cube_reduced.shape),
+                                                        long_name=coord.name()+" of "+stat[:3], var_name=stat[:3]+"_"+coord.var_name,
+                                                        units=coord.units), tuple(range(cube_reduced.ndim)))
 
-    if outfile is None:
-        outfile=".".join(infile.split(".")[:-1])+"_reduced."+infile.split(".")[-1]
+def get_time_dim(cube):
+    '''
+    Return the dimension of the time dimension coordinate of a cube, or None.
+    '''
+    time_coords = cube.coords(axis="T", dim_coords=True)
+    return cube.coord_dims(time_coords[0])[0] if time_coords else None
 
-    if invars is None:
-        cubes = iris.load(infile)
-    else:
-        cubes = [read_cube(infile,varname) for varname in invars]
-        
-    # Filter for subdomain
-    tmask_cube = iris.load_cube(tmask[0])
-    nav_lev_index = tmask_cube.coord_dims('nav_lev')[0]
-    nav_lev_index = tuple([0 if i == nav_lev_index else slice(None) for i in range(tmask_cube.data.ndim)]) # index to filter surface
+def get_chunks(shape,dtype,chunk_size=CHUNK_SIZE):
+    '''
+    Return dask chunks for an array of the given shape: whole horizontal
+    slices, with the leading dimensions (time, depth) split so that a chunk
+    is at most about chunk_size MiB.
+    '''
+    auto = ("auto",)*(len(shape)-2) + (-1,)*min(len(shape),2)
+    return da.core.normalize_chunks(auto,shape,limit=chunk_size*2**20,dtype=dtype)
 
-    for cube in cubes[1:]:
-        assert cubes[0].shape == cube.shape, "All input cubes must have the same shape"
-    
+def crop_field(field,crop):
+    '''
+    Restrict an array to crop, a tuple of slices of its trailing grid
+    dimensions. Dimensions of size 1 (broadcast, e.g. the t dimension
+    of e1t) are kept whole.
+    '''
+    n = min(len(crop), len(field.shape))
+    slices = tuple(slice(None) if size == 1 else c for size, c in zip(field.shape[len(field.shape)-n:], crop[len(crop)-n:]))
+    return field[(Ellipsis,)+slices]
+
+def collapse_full_coords(cube_reduced,cube,coords):
+    '''
+    Replace the coordinates of cube_reduced, collapsed from a crop of cube to
+    a tmask bounding box, by the ones collapsed over the whole grid of cube,
+    so that the output coordinates are the ones of a collapse of the whole cube.
+    '''
+    collapsed_dims = set(dim for coord in coords for dim in cube.coord_dims(coord))
+    for coord in cube.coords():
+        coord_dims = cube.coord_dims(coord)
+        if collapsed_dims.intersection(coord_dims):
+            cube_reduced.replace_coord(coord.collapsed([n for n, dim in enumerate(coord_dims) if dim in collapsed_dims]))
+
+def reduce_region(cubes,regions,coords,stats,wgts_sources,surface,chunk_size=CHUNK_SIZE,
+                  wgtsstore=None,total_keys=None,tblock=None):
+    '''
+    Reduce the cubes over their whole grid (horizontal and, if present, vertical
+    dimensions) restricted to each of the tmask regions (list of (mask, box) from
+    read_tmask), using the sparse representation of the regions (util.get_region_index):
+    only the union of the bounding boxes of the regions is read, once for all the
+    regions, and all the statistics (util.region_stats) are computed from this read;
+    the weighted mean is a gather + dot product.
+    The first leading dimension (time) is processed in blocks of tblock steps, or
+    of about chunk_size MiB of data read, so memory use does not grow with the
+    length of the input.
+    If the weights are static (a single array from the weights store wgtsstore),
+    the total weight of each region is also stored, keyed by total_keys.
+    Returns the list of the reduced cubes of each region (one per cube and statistic,
+    named <stat>_<var_name> if there are several statistics), or None if the coordinates
+    to reduce over are not exactly the grid dimensions of the cubes, in which case
+    the masked path has to be used.
+    '''
+    cubes_reduced = [[] for region in regions]
+    for cube in cubes:
+        depth_coord = get_depth_coord(cube)
+        if surface and depth_coord is not None:
+            depth_index = cube.coord_dims(depth_coord)[0]
+            cube = cube[tuple([0 if i == depth_index else slice(None) for i in range(cube.ndim)])]
+            depth_coord = None
+
+        if depth_coord is None:
+            # surface level of the regions
+            region_masks = [mask[0] if box[0].start == 0 else np.zeros_like(mask[0]) for (mask, box) in regions]
+            region_boxes = [box[1:] for (mask, box) in regions]
+        else:
+            region_masks = [mask for (mask, box) in regions]
+            region_boxes = [box for (mask, box) in regions]
+
+        ngrid = len(region_boxes[0])
+        collapsed_dims = set(dim for coord in coords for dim in cube.coord_dims(coord))
+        if collapsed_dims != set(range(cube.ndim - ngrid, cube.ndim)):
+            return None
+
+        # flat indices of the points of each region in the box read
+        read = union_box(region_boxes)
+        read_shape = tuple(b.stop - b.start for b in read)
+        indices = [get_region_index(expand_tmask(mask, tuple(slice(b.start - r.start, b.stop - r.start) for (b, r) in zip(box, read)), read_shape))
+                   for (mask, box) in zip(region_masks, region_boxes)]
+
+        lead = cube.shape[:cube.ndim - ngrid]
+        nblock = lead[0] if lead else 1
+        step = max(1, int(chunk_size*2**20 // (8 * np.prod(read_shape, dtype=int) * np.prod(lead[1:], dtype=int)))) if lead else 1
+        if tblock and lead:
+            step = tblock
+        in_block = lambda field: nblock > 1 and len(field.shape) > ngrid and field.shape[0] == nblock # field with the blocked dimension
+        read_flat = lambda field: read_box(field, read).reshape(field.shape[:len(field.shape) - ngrid] + (-1,))
+
+        # weights without the blocked dimension (e.g. e1t, e2t) are read once
+        static_wgts = None
+        blocked_wgts = []
+        for wgts_source in (wgts_sources or []):
+            if in_block(wgts_source):
+                blocked_wgts.append(wgts_source)
+            else:
+                wgts = read_flat(wgts_source)
+                static_wgts = wgts if static_wgts is None else static_wgts * wgts
+
+        totals = [None for region in regions]
+        if wgtsstore is not None and total_keys is not None and static_wgts is not None and not blocked_wgts:
+            totals = [store_value(wgtsstore, "weights_totals", get_cache_key(key, ngrid),
+                                  lambda: float(np.nansum(static_wgts[..., index])))
+                      for (key, index) in zip(total_keys, indices)]
+
+        results = [[] for region in regions]
+        for i0 in range(0, nblock, step):
+            block = lambda field: field[i0:i0+step] if in_block(field) else field
+            values = read_flat(block(cube.core_data()))
+            wgts = static_wgts
+            for wgts_source in blocked_wgts:
+                wgts = read_flat(block(wgts_source)) if wgts is None else wgts * read_flat(block(wgts_source))
+            for (result, index, total) in zip(results, indices, totals):
+                result.append(region_stats(values[..., index], None if wgts is None else wgts[..., index], stats, total))
+
+        for (region_cubes, result, box, index) in zip(cubes_reduced, results, region_boxes, indices):
+            cube_box = cube[(slice(None),)*len(lead) + tuple(box)]
+            for stat in stats:
+                # metadata of the reduced cube from a lazy collapse over the bounding box (with the
+                # coordinates of the whole grid), data from the region reduction
+                aggregator, kwargs = get_aggregator(stat)
+                cube_reduced = cube_box.collapsed(coords, aggregator, **kwargs)
+                collapse_full_coords(cube_reduced, cube, coords)
+                stat_result = [block[stat] for block in result]
+                if stat in ("minloc", "maxloc"):
+                    stat_index = (np.concatenate([block[1] for block in stat_result]) if lead else stat_result[0][1]).ravel()
+                    stat_result = [block[0] for block in stat_result]
+                    points = np.unravel_index(index[stat_index.clip(0)], read_shape)
+                    add_location_coords(cube_reduced, cube, stat,
+                                        [np.where(stat_index >= 0, p + r.start, -1) for (p, r) in zip(points, read)])
+                stat_result = (np.concatenate(stat_result) if lead else stat_result[0]).reshape(cube_reduced.shape)
+                dtype = cube.dtype if stat in ("min", "max", "minloc", "maxloc") else np.result_type(cube.dtype, np.float64) # as the masked iris collapse
+                cube_reduced.data = ma.masked_invalid(stat_result).astype(dtype)
+                for coord in cube_reduced.coords():
+                    if "percent" in kwargs and coord.name().startswith("percentile_over"):
+                        coord.var_name = stat+"_percent" # one scalar coordinate per percentile
+                if len(stats) > 1:
+                    cube_reduced.var_name = stat+"_"+cube.var_name
+                region_cubes.append(cube_reduced)
+
+    return cubes_reduced
+
+def reduce_masked(cubes,mask,box,shape,coords,aggregator,wgtsfiles,wgts_sources,surface,subdomain_file,chunk_size):
+    '''
+    Reduce the cubes over coords restricted to one tmask region by masking them.
+    Data, masks and weights are kept as dask arrays and the collapse is computed
+    chunk by chunk when saving. Along the grid dimensions reduced over, only the
+    hyperslab of the tmask bounding box is read.
+    The masked fields are saved to subdomain_file if it is not None.
+    '''
+    cubes = list(cubes)
+    full_cubes = [] # cubes before the crop, for the coordinates of the reduced cubes
     for i, cube in enumerate(cubes):
 
-        depth_coord = next(
-            (coord for coord in (list(cube.dim_coords) + list(cube.aux_coords))
-             if coord.var_name in ("deptht", "depthu", "depthv")),
-            None
-        )
+        cube = cube.copy() # cubes may be shared with other reductions (see reduce_batch)
+        depth_coord = get_depth_coord(cube)
         has_depth = depth_coord is not None
 
         if surface and has_depth:
             depth_index = cube.coord_dims(depth_coord)[0]
-            depth_index = tuple([0 if i == depth_index else slice(None) for i in range(cube.data.ndim)]) # index to filter surface
-            tmask = tmask_cube.data[nav_lev_index]
+            depth_index = tuple([0 if i == depth_index else slice(None) for i in range(cube.ndim)]) # index to filter surface
             cube = cube[depth_index]
-        elif surface or not has_depth:
-            tmask = tmask_cube.data[nav_lev_index]
-        elif has_depth:
-            tmask = tmask_cube.data
+
+        grid_box = box if has_depth and not surface else box[1:] # surface level of the tmask otherwise
+        ngrid = len(grid_box)
+        collapsed_dims = set(dim for coord in coords for dim in cube.coord_dims(coord))
+        crop = tuple(b if cube.ndim - ngrid + n in collapsed_dims else slice(None) for n, b in enumerate(grid_box))
+        full_cubes.append(cube)
+        cube = cube[(slice(None),)*(cube.ndim-ngrid) + crop]
+        tmask = expand_tmask(mask, box, shape, window=(slice(0, 1),)*(len(box)-ngrid) + crop)
+        tmask = tmask.reshape(tmask.shape[len(box)-ngrid:]) # nav_lev x y x x or y x x array
         
         tmask = ~tmask.astype(bool) # Ensure tmask is of type bool. Inverse values as ma.masked_where keeps False values.
-        tmask = np.broadcast_to(tmask, cube.data.shape)
-        cube.data = ma.masked_where(tmask, cube.data) # mask data using tmask for lat, lon and depth
+        data = da.asarray(cube.core_data())
+        data = data.rechunk(get_chunks(data.shape, data.dtype, chunk_size))
+        tmask = da.broadcast_to(da.from_array(tmask, chunks=data.chunks[data.ndim-tmask.ndim:]), data.shape, chunks=data.chunks)
+        cube.data = da.ma.masked_where(tmask, data) # mask data using tmask for lat, lon and depth
         cubes[i] = cube
     
-    if subout:
-        subdomain_file=".".join(outfile.split(".")[:-1])+"_subdomain."+outfile.split(".")[-1]
+    if subdomain_file is not None:
         iris.save(cubes,subdomain_file)
         
+    if wgts_sources is not None:
+        wgts_list = [crop_field(da.asarray(wgts),crop) for wgts in wgts_sources]
+        wgts=wgts_list[0]        
+        if len(wgts_list) > 1:
+            for wgts_to_multiply in wgts_list[1:]:
+                wgts = wgts * wgts_to_multiply
+        elif wgtsfiles[0] == "measures":
+            # in this case, broadcast the weights to be the same shape as the cube... 
+            wgts = da.broadcast_to(wgts, cubes[0].shape)
+        
+        assert wgts.shape == cubes[0].shape, f"Weights array must have shape {cubes[0].shape} but has shape {wgts.shape}"
+
+        wgts = da.ma.masked_where(tmask, wgts.rechunk(tmask.chunks)) # mask weights using tmask for lat, lon and depth
+
+    else:
+        wgts = None
+                    
+    if aggregator is not iris.analysis.MEAN:
+        # no weights keyword
+        cubes_reduced = [cube.collapsed(coords, aggregator) for cube in cubes]
+    else:
+        cubes_reduced = [cube.collapsed(coords, aggregator, weights=wgts) for cube in cubes]
+    for (cube_reduced, cube) in zip(cubes_reduced, full_cubes):
+        collapse_full_coords(cube_reduced, cube, coords)
+    return cubes_reduced
+
+def save_regions(cubes_reduced,outfiles,regions):
+    '''
+    Save the reduced cubes of each region, either to one file per region
+    or, if a single output file is given for several regions, to one file
+    where the regions are a "region" dimension (region index, with the
+    region names as a "region_name" coordinate).
+    '''
+    if len(outfiles) == len(cubes_reduced):
+        for (region_cubes, outfile) in zip(cubes_reduced, outfiles):
+            iris.save(region_cubes, outfile)
+        return
+
+    merged = []
+    for region_cubes in zip(*cubes_reduced): # the same field in each region
+        cubelist = iris.cube.CubeList()
+        for n, (cube, region) in enumerate(zip(region_cubes, regions)):
+            cube = cube.copy()
+            cube.add_aux_coord(iris.coords.DimCoord(n, long_name="region", var_name="region"))
+            cube.add_aux_coord(iris.coords.AuxCoord(region, long_name="region name", var_name="region_name"))
+            cubelist.append(cube)
+        merged.append(cubelist.merge_cube())
+    iris.save(merged, outfiles[0])
+
+def reduce_fields(infile,tmask,invars=None,coords=None,wgtsfiles=None,wgtsnames=None,
+                  aggr=None,outfile=None,subout=None,surface=None,cache=None,chunk_size=None,
+                  regions=None,wgtsstore=None,tblock=None):
+
+    if infile is None:
+        raise Exception("Error: must specify input file")
+
+    if aggr is None:
+        aggr="mean"
+    stats = aggr if isinstance(aggr,list) else [aggr] # several statistics from one read of the fields
+    for stat in stats:
+        get_aggregator(stat)
+
+    if chunk_size is None:
+        chunk_size=CHUNK_SIZE
+
+    if outfile is None:
+        outfile=".".join(infile.split(".")[:-1])+"_reduced."+infile.split(".")[-1]
+    outfiles = outfile if isinstance(outfile,list) else [outfile]
+    if len(outfiles) not in (1, len(tmask)):
+        raise Exception("Must specify one output file or the same number as the number of tmask files")
+
+    if regions is None:
+        regions = [os.path.splitext(os.path.basename(tmask_file))[0] for tmask_file in tmask]
+    if len(regions) != len(tmask):
+        raise Exception("Must specify the same number of region names as the number of tmask files")
+
+    if invars is None:
+        cubes = list(cached(cache,("cubes",infile),lambda: iris.load(infile)))
+    else:
+        cubes = [read_cube(infile,varname,cache=cache) for varname in invars]
+        
+    # Filter for subdomains, one per tmask file
+    tmasks = [cached(cache,("tmask",tmask_file),lambda: read_tmask(tmask_file)) for tmask_file in tmask] # tmask in its bounding box, compact or full tmask file
+    shape = tmasks[0][2]
+    for (tmask_file, (mask, box, tmask_shape)) in zip(tmask, tmasks):
+        assert tmask_shape == shape, f"All tmasks must be on the same grid, {tmask_file} is not"
+
+    for cube in cubes[1:]:
+        assert cubes[0].shape == cube.shape, "All input cubes must have the same shape"
+
     if coords is None:
         coords = "time"
+    if not isinstance(coords,list):
+        coords = [coords]
 
     if wgtsnames is not None:
         if not isinstance(wgtsnames,list):
@@ -143,58 +450,152 @@ def reduce_fields(infile,tmask,invars=None,coords=None,wgtsfiles=None,wgtsnames=
         wgtsfiles = [infile if wf == "self" else wf for wf in wgtsfiles]
         if len(wgtsfiles) != len(wgtsnames):
             raise Exception("Must specify one weights file or the same number as the number of weights fields")
-        wgts_list = [get_weights(wgtsfile,wgtsname,cubes[0]) for (wgtsfile,wgtsname) in zip(wgtsfiles,wgtsnames)]
-        wgts=wgts_list[0]        
-        if len(wgts_list) > 1:
-            for wgts_to_multiply in wgts_list[1:]:
-                wgts = wgts * wgts_to_multiply
-        elif wgtsfiles[0] == "measures":
-            # in this case, broadcast the weights to be the same shape as the cube... 
-            wgts = ma.ones(cubes[0].shape)[:] * wgts[:]
-        
-        assert wgts.shape == cubes[0].shape, f"Weights array must have shape {cubes[0].shape} but has shape {wgts.shape}"
 
-        wgts[:] = ma.masked_where(tmask, wgts[:]) # mask weights using tmask for lat, lon and depth
+    wgts_sources = None
+    total_keys = None
+    if wgtsnames is not None and any(stat in ("mean", "std", "var") or stat.startswith("p") for stat in stats):
+        wgts_sources = [get_weights(wgtsfile,wgtsname,cubes[0],lazy=True,cache=cache) for (wgtsfile,wgtsname) in zip(wgtsfiles,wgtsnames)]
 
-    else:
-        wgts = None
-                    
-    if aggr in ["min","max"]:
-        # no weights keyword
-        cubes_reduced=[cube.collapsed(coords, aggregators[aggr]) for cube in cubes]
-    else:
-        cubes_reduced=[cube.collapsed(coords, aggregators[aggr], weights=wgts) for cube in cubes]
+        # Static weights (neither from the input file nor cell measures, e.g. e1t e2t of
+        # the mesh) are multiplied once per mesh and kept in the weights store
+        static = [n for n, wgtsfile in enumerate(wgtsfiles) if wgtsfile not in (infile, "measures")]
+        if wgtsstore and static:
+            os.makedirs(wgtsstore, exist_ok=True)
+            wgts_key = get_cache_key("weights", [get_file_hash(wgtsfiles[n], wgtsstore) for n in static], [wgtsnames[n] for n in static])
+            stored = store_array(wgtsstore, wgts_key, lambda: functools.reduce(np.multiply, [get_weights(wgtsfiles[n],wgtsnames[n],cubes[0],cache=cache) for n in static]))
+            wgtsfiles = [wgtsfile for n, wgtsfile in enumerate(wgtsfiles) if n not in static] + ["store"]
+            wgts_sources = [wgts for n, wgts in enumerate(wgts_sources) if n not in static] + [stored]
+            if len(wgts_sources) == 1:
+                total_keys = [get_cache_key(wgts_key, get_file_hash(tmask_file, wgtsstore), bool(surface)) for tmask_file in tmask]
 
-    iris.save(cubes_reduced, outfile)
+    # Sparse region reduction, all the regions from a single read, when
+    # reducing over the whole grid of the regions
+    if not subout:
+        cubes_reduced = reduce_region(cubes,[(mask, box) for (mask, box, tmask_shape) in tmasks],coords,
+                                      stats,wgts_sources,surface,chunk_size,
+                                      wgtsstore,total_keys,tblock)
+        if cubes_reduced is not None:
+            save_regions(cubes_reduced, outfiles, regions)
+            return
 
+    if len(stats) > 1 or stats[0] not in ("mean", "min", "max"):
+        raise Exception("Statistics "+", ".join(stats)+" need a reduction over the whole grid of the regions (-c with all the grid coordinates, without -M)")
+    aggregator = get_aggregator(stats[0])[0]
 
-if __name__=="__main__":
+    # Masked path, one region at a time. With tblock, when time is not reduced over,
+    # the cubes are streamed: reduced tblock time steps at a time, the reduced
+    # blocks being concatenated at the end.
+    time_dim = get_time_dim(cubes[0]) if tblock and not subout else None
+    if time_dim is not None and time_dim in set(dim for coord in coords for dim in cubes[0].coord_dims(coord)):
+        time_dim = None
+    ntime = cubes[0].shape[time_dim] if time_dim is not None else 1
+    tslices = [slice(None)] if time_dim is None else [slice(i0, i0+tblock) for i0 in range(0, ntime, tblock)]
+
+    cubes_reduced = []
+    for n, (mask, box, tmask_shape) in enumerate(tmasks):
+        subdomain_file = None
+        if subout:
+            subdomain_outfile = outfiles[n] if len(outfiles) > 1 else outfiles[0]
+            subdomain_suffix = "_subdomain" if len(tmasks) == 1 or len(outfiles) > 1 else "_subdomain_"+regions[n]
+            subdomain_file=".".join(subdomain_outfile.split(".")[:-1])+subdomain_suffix+"."+subdomain_outfile.split(".")[-1]
+        if len(tslices) == 1:
+            cubes_reduced.append(reduce_masked(cubes,mask,box,shape,coords,aggregator,wgtsfiles,wgts_sources,
+                                               surface,subdomain_file,chunk_size))
+            continue
+
+        blocks_reduced = []
+        for tslice in tslices:
+            print("Reducing time steps",tslice.start,"to",min(tslice.stop,ntime)-1,"of",ntime)
+            index = (slice(None),)*time_dim + (tslice,)
+            block_wgts = None if wgts_sources is None else \
+                [wgts[index] if len(wgts.shape) == cubes[0].ndim and wgts.shape[time_dim] == ntime else wgts for wgts in wgts_sources]
+            block_reduced = reduce_masked([cube[index] for cube in cubes],mask,box,shape,coords,aggregator,
+                                          wgtsfiles,block_wgts,surface,None,chunk_size)
+            for cube in block_reduced:
+                cube.data # computed now, so that memory use is bounded by one block
+            blocks_reduced.append(block_reduced)
+        cubes_reduced.append([iris.cube.CubeList(field_blocks).concatenate_cube() for field_blocks in zip(*blocks_reduced)])
+
+    save_regions(cubes_reduced, outfiles, regions)
+
+def reduce_batch(manifest,chunk_size=None,wgtsstore=None,tblock=None):
+    '''
+    Run all the reductions listed in a JSON manifest in one process.
+    The manifest is a list of reductions, each one a dictionary of the
+    arguments of reduce_fields, e.g.
+
+    [{"infile": "T.nc", "invars": ["thetao_pot"], "tmask": ["tmask_AMU.nc"],
+      "coords": ["longitude", "latitude", "depth"], "aggr": "mean",
+      "wgtsfiles": ["self", "mesh.nc", "mesh.nc"],
+      "wgtsnames": ["cell_thickness", "e1t", "e2t"], "outfile": "AMU_T.nc"}, ...]
+
+    Input cubes, weights and tmasks shared by several reductions are read once.
+    chunk_size, wgtsstore and tblock are used for the reductions that do not set their own.
+    '''
+    with open(manifest) as f:
+        reductions = json.load(f)
+
+    cache = {}
+    for kwargs in reductions:
+        if isinstance(kwargs.get("tmask"),str):
+            kwargs["tmask"] = [kwargs["tmask"]]
+        print("Reducing",kwargs.get("invars"),"from",kwargs.get("infile"),"to",kwargs.get("outfile"))
+        kwargs.setdefault("chunk_size",chunk_size)
+        kwargs.setdefault("wgtsstore",wgtsstore)
+        kwargs.setdefault("tblock",tblock)
+        reduce_fields(**kwargs,cache=cache)
+
+
+def main(argv=None):
+    '''
+    Command line interface, argv being the arguments (default sys.argv[1:]).
+    '''
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--infile", action="store", dest="infile", 
-                         help="names of input file", required=True)
+                         help="names of input file")
     parser.add_argument("-v", "--vars", action="store", dest="invars", nargs="+", 
                          help="names of input variables")
     parser.add_argument("-G", "--wgtsfiles", action="store", dest="wgtsfiles", nargs="+",
                          help="names of weights file or 'self' if input file or 'measures' if a cell measure")
     parser.add_argument("-g", "--wgtsnames", action="store", dest="wgtsnames", nargs="+",
                          help="names of weighting variable")
-    parser.add_argument("-o", "--outfile", action="store", dest="outfile",
-                         help="name of output file (format by extension)")
+    parser.add_argument("-o", "--outfile", action="store", dest="outfile", nargs="+",
+                         help="name of output file (format by extension), or one per tmask file")
     parser.add_argument("-c", "--coords", action="store",dest="coords",nargs="+",
                          help="name of coordinates to reduce over (default time)")
-    parser.add_argument("-A", "--aggr", action="store",dest="aggr",
-                         help="name of aggregator: mean, max, min")
+    parser.add_argument("-A", "--aggr", action="store",dest="aggr",nargs="+",
+                         help="name of aggregator: mean, max, min, or several statistics computed from one read: "
+                              "mean std var min max minloc maxloc pNN (percentile, e.g. p90)")
     parser.add_argument("-M", "--subout", action="store_true",dest="subout",
                          help="output fields on subdomain to file as sanity check")
     parser.add_argument("-m", "--tmask", action="store",dest="tmask", 
-                         help="tmask file", nargs=1, type=str, required=True),
+                         help="tmask files, the field is read once and reduced over each of them", nargs="+", type=str),
+    parser.add_argument("-R", "--regions", action="store",dest="regions", nargs="+",
+                         help="names of the regions of the tmask files, for the region dimension of a single output file (default tmask file names)")
+    parser.add_argument("-B", "--batch", action="store", dest="batch",
+                         help="JSON manifest of reductions to run in one process (see reduce_batch), instead of -i/-m")
     parser.add_argument("-S", "--surf", dest="surface", action="store_true", 
                          help="flag to indicate surface-only reduction")
-    args = parser.parse_args()
+    parser.add_argument("-W", "--wgtsstore", dest="wgtsstore", action="store", default=os.environ.get("WEIGHTS_STORE"),
+                         help="directory of the weights store, where static weights (e.g. e1t*e2t of a mesh) are kept (default $WEIGHTS_STORE)")
+    parser.add_argument("-T", "--tblock", dest="tblock", action="store", type=int,
+                         help="number of time steps reduced at a time (default: blocks of about the chunk size)")
+    parser.add_argument("-C", "--chunk", dest="chunk_size", action="store", type=float,
+                         help=f"size of the chunks the reduction is computed by, in MiB (default {CHUNK_SIZE})")
+    args = parser.parse_args(argv)
+
+    if args.batch:
+        reduce_batch(args.batch,chunk_size=args.chunk_size,wgtsstore=args.wgtsstore,tblock=args.tblock)
+        return
+    if args.infile is None or args.tmask is None:
+        parser.error("the following arguments are required: -i/--infile, -m/--tmask (or -B/--batch)")
 
     reduce_fields(infile=args.infile,tmask=args.tmask,invars=args.invars,outfile=args.outfile,
                   wgtsfiles=args.wgtsfiles,wgtsnames=args.wgtsnames,coords=args.coords,aggr=args.aggr,
-                  subout=args.subout,surface=args.surface)
+                  subout=args.subout,surface=args.surface,chunk_size=args.chunk_size,regions=args.regions,
+                  wgtsstore=args.wgtsstore,tblock=args.tblock)
 
 
+if __name__=="__main__":
+    main()
@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+
+'''
+Resident worker for reduce_fields.py, to avoid paying the start-up cost of
+python, iris and netCDF4 for each reduction.
+
+The worker imports reduce_fields once and listens on a unix socket. Each
+request is the command line of a reduce_fields.py call; it is run in a forked
+child of the worker, in the working directory and with the environment of the
+caller, and its output and exit status are sent back to the caller.
+
+Start the worker with:
+
+    reduce_worker.py -s /path/to/socket &
+    export REDUCE_SOCKET=/path/to/socket
+
+reduce_fields.py then sends its reductions to the worker, and runs them
+itself if no worker is listening on $REDUCE_SOCKET.
+'''
+
+import os
+import sys
+import json
+import signal
+import socket
+
+EXIT_MARK = b"\0" # separates the output of a request from its exit status
+
+def submit(socket_path, argv, cwd=None, env=None):
+    '''
+    Send a reduce_fields.py command line to the worker listening on socket_path,
+    copy its output to stdout and return its exit status.
+    Returns None if no worker is listening, so that the caller can run the
+    reduction itself.
+    '''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        return None
+
+    request = {"argv": list(argv), "cwd": cwd or os.getcwd(), "env": dict(os.environ if env is None else env)}
+    with client:
+        client.sendall(json.dumps(request).encode() + b"\n")
+        client.shutdown(socket.SHUT_WR)
+
+        received = b""
+        while True:
+            chunk = client.recv(1 << 16)
+            if not chunk:
+                break
+            received += chunk
+            # output is copied as it comes, up to a possible exit mark
+            output, mark, received = received.partition(EXIT_MARK)
+            sys.stdout.buffer.write(output)
+            sys.stdout.flush()
+            received = mark + received
+
+    if not received.startswith(EXIT_MARK):
+        print("reduce_worker: request interrupted", file=sys.stderr)
+        return 1
+    return int(received[len(EXIT_MARK):] or 1)
+
+def run_request(connection, main):
+    '''
+    Run one request in the current (forked) process: the command line is read
+    from the connection, stdout and stderr are redirected to it, and the exit
+    status is sent after the output.
+    '''
+    reader = connection.makefile("rb")
+    request = json.loads(reader.readline())
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+    sys.argv = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "reduce_fields.py")] + request["argv"]
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(connection.fileno(), 1)
+    os.dup2(connection.fileno(), 2)
+
+    status = 0
+    try:
+        main(request["argv"])
+    except SystemExit as exit:
+        status = exit.code if isinstance(exit.code, int) else (0 if exit.code is None else 1)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        status = 1
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    connection.sendall(EXIT_MARK + str(status).encode())
+
+def serve(socket_path):
+    '''
+    Listen on socket_path and run each request in a forked child,
+    so that requests run concurrently and do not share any state.
+    '''
+    from reduce_fields import main # the expensive imports, done once
+
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            if probe.connect_ex(socket_path) == 0:
+                raise Exception("A worker is already listening on "+socket_path)
+        os.remove(socket_path) # left by a worker that did not stop cleanly
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(64)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN) # children are reaped automatically
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # the socket is removed on kill
+    print("reduce_worker: listening on", socket_path, flush=True)
+
+    try:
+        while True:
+            connection, _ = server.accept()
+            if os.fork() == 0:
+                server.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                try:
+                    run_request(connection, main)
+                finally:
+                    os._exit(0)
+            connection.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--socket", action="store", dest="socket", default=os.environ.get("REDUCE_SOCKET"),
+                         help="path of the unix socket to listen on (default $REDUCE_SOCKET)")
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error("a socket path is required: -s or $REDUCE_SOCKET")
+
+    serve(args.socket)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+'''
+Seawater state of the T files (TEOS-10), computed once and shared by the
+metrics that need density:
+
+    SA                      absolute salinity (g/kg)
+    CT                      conservative temperature (degC)
+    sigma0, sigma2, sigma4  potential density anomalies referenced to 0, 2000
+                            and 4000 dbar (kg/m3)
+
+The sea pressure of a grid (depth of the T points and latitude) is computed
+once and kept in the store ($WEIGHTS_STORE). The state of a T file is kept,
+as float32, in <T file>_state.nc alongside it, or <T file>_state_<depth>.nc
+when the pressure is that of a depth variable of a mesh (in the store if
+the directory is not writable). It is computed again only when the T file
+or the source of the pressure change, and extended when more variables
+are needed:
+
+    seawater_state.py nemo_*_grid-T.nc -var sigma0 sigma2
+'''
+
+import os
+import hashlib
+import argparse
+import numpy as np
+import netCDF4 as nc4
+from util import get_file_hash, get_cache_key, cache_lookup
+
+STATE_VERSION = 2 # version of the state files, part of their validity check
+
+STATE_VARIABLES = {
+     "SA": ("absolute salinity", "g/kg"),
+     "CT": ("conservative temperature", "degC"),
+     "sigma0": ("potential density anomaly referenced to 0 dbar", "kg/m3"),
+     "sigma2": ("potential density anomaly referenced to 2000 dbar", "kg/m3"),
+     "sigma4": ("potential density anomaly referenced to 4000 dbar", "kg/m3"),
+}
+
+def teos10_state(ptemp, psal, pres, lon, lat, variables=STATE_VARIABLES):
+    '''
+    TEOS-10 state (name -> array, see STATE_VARIABLES) from the potential
+    temperature and practical salinity, at the sea pressure (dbar), longitude
+    and latitude of the points (broadcast together as numpy arrays).
+    '''
+    import gsw
+    abs_s = gsw.SA_from_SP(psal, pres, lon, lat)
+    con_t = gsw.CT_from_pt(abs_s, ptemp)
+    state = {"SA": abs_s, "CT": con_t}
+    for name in variables:
+        if name.startswith("sigma"):
+            state[name] = getattr(gsw.density, name)(abs_s, con_t)
+    return {name: state[name] for name in variables}
+
+def get_pressure(depth, lat, store=None, key=None):
+    '''
+    Sea pressure (dbar) at the depths (levels or a field with the levels
+    first) and latitudes of a grid, levels x lat shape, float32. With a
+    store, it is computed once per grid and read as a memory map; the
+    entry is identified by key if given (e.g. from the hash of the mesh
+    file), by the content of depth and lat otherwise.
+    '''
+    import gsw
+    depth, lat = np.asarray(depth, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    if depth.ndim == 1:
+        depth = depth.reshape(depth.shape + (1,) * lat.ndim)
+    shape = (depth.shape[0],) + lat.shape
+    level = lambda k: np.broadcast_to(gsw.p_from_z(-depth[k], lat), lat.shape).astype(np.float32)
+    if not store:
+        return np.stack([level(k) for k in range(shape[0])])
+
+    os.makedirs(store, exist_ok=True)
+    if key is None:
+        key = hashlib.blake2b(depth.tobytes() + lat.tobytes(), digest_size=16).hexdigest()
+    entry, hit = cache_lookup(store, get_cache_key("pressure", STATE_VERSION, key, shape), ext=".npy")
+    if not hit:
+        # written level by level, so that the full grid is never in memory
+        tmp_file = f"{entry}.{os.getpid()}.tmp.npy"
+        pres = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.float32, shape=shape)
+        for k in range(shape[0]):
+            pres[k] = level(k)
+        pres.flush()
+        del pres
+        os.replace(tmp_file, entry)
+    return np.load(entry, mmap_mode="r")
+
+def get_state_file(tfile, store=None, depth_var=None):
+    '''
+    State file of a T file, one per source of the sea pressure (levels of
+    the T file, or depth_var of a mesh): alongside the T file, or in the
+    store if its directory is not writable.
+    '''
+    tfile = os.path.realpath(tfile)
+    suffix = "_state.nc" if depth_var is None else f"_state_{depth_var}.nc"
+    if os.access(os.path.dirname(tfile), os.W_OK) or not store:
+        return os.path.splitext(tfile)[0] + suffix
+    return os.path.join(store, get_cache_key("state", tfile) + suffix)
+
+def get_pressure_source(mesh, depth_var, store):
+    '''
+    Identification of the source of the sea pressure: the levels of the T
+    file, or depth_var of the mesh file (by the hash of its content).
+    '''
+    if mesh is None:
+        return "levels of the T file"
+    return f"{depth_var} of mesh {get_file_hash(mesh, store)}"
+
+def get_source_stamp(tfile, temp, sal, pressure):
+    '''
+    Identification of the T file, variables and sea pressure a state file
+    is computed from.
+    '''
+    stat = os.stat(os.path.realpath(tfile))
+    return {"state_version": str(STATE_VERSION), "source": os.path.realpath(tfile), "source_size": str(stat.st_size),
+            "source_mtime_ns": str(stat.st_mtime_ns), "temperature": temp, "salinity": sal, "pressure": pressure}
+
+def build_state(tfile, state_file, variables, temp, sal, mesh, depth_var, store):
+    '''
+    Computes the state variables of a T file into state_file, one level of
+    one time step at a time.
+    '''
+    pressure = get_pressure_source(mesh, depth_var, store)
+    with nc4.Dataset(tfile) as src:
+        ptemp, psal = src[temp], src[sal]
+        lon, lat = [np.asarray(src[name][:], dtype=np.float64).reshape(src[name].shape[-2:]) for name in ("nav_lon", "nav_lat")]
+        if mesh is None:
+            zdim = ptemp.dimensions[-3]
+            pres = get_pressure(src[zdim][:] if zdim in src.variables else src["deptht"][:], lat, store)
+        else:
+            with nc4.Dataset(mesh) as ds:
+                depth = np.asarray(ds[depth_var][:], dtype=np.float64)
+                gphit = np.asarray(ds["gphit"][:], dtype=np.float64).reshape(ds["gphit"].shape[-2:])
+            depth = depth.reshape(depth.shape[-3:] if depth.ndim >= 3 else depth.shape[-1:])
+            pres = get_pressure(depth, gphit, store, key=pressure if store else None)
+
+        tmp_file = f"{state_file}.{os.getpid()}.tmp"
+        with nc4.Dataset(tmp_file, "w") as ds:
+            ds.setncatts(get_source_stamp(tfile, temp, sal, pressure))
+            for dim in ptemp.dimensions:
+                ds.createDimension(dim, None if src.dimensions[dim].isunlimited() else len(src.dimensions[dim]))
+            out = {}
+            for name in variables:
+                out[name] = ds.createVariable(name, "f4", ptemp.dimensions, fill_value=np.float32(1.e20))
+                out[name].long_name, out[name].units = STATE_VARIABLES[name]
+
+            for lead in np.ndindex(ptemp.shape[:-3]):
+                for k in range(ptemp.shape[-3]):
+                    idx = lead + (k,)
+                    values = [np.ma.filled(np.ma.asarray(v[idx]).astype(np.float64), np.nan) for v in (ptemp, psal)]
+                    state = teos10_state(*values, pres[k], lon, lat, variables)
+                    for name in variables:
+                        out[name][idx] = np.ma.masked_invalid(state[name].astype(np.float32))
+    os.replace(tmp_file, state_file)
+
+def open_state(tfile, variables, temp="thetao_pot", sal="so_pra", mesh=None, depth_var="gdept_0", store=os.environ.get("WEIGHTS_STORE")):
+    '''
+    Opens (netCDF4.Dataset) the state of a T file with at least the given
+    variables, computing it if it is missing, out of date or incomplete.
+    The state has the dimensions of the temperature of the T file; its sea
+    pressure is computed from the depth of the levels of the T file, or
+    from depth_var (levels or a z x y x x field) and gphit of the mesh file
+    if given. Each source of the pressure has its own state file, so that
+    the metrics using different ones do not recompute each other's state.
+    '''
+    state_file = get_state_file(tfile, store, None if mesh is None else depth_var)
+    stamp = get_source_stamp(tfile, temp, sal, get_pressure_source(mesh, depth_var, store))
+    for _ in range(3): # the state may be replaced by another job while being opened
+        existing = set()
+        if os.path.exists(state_file):
+            ds = nc4.Dataset(state_file)
+            if all(getattr(ds, key, None) == value for key, value in stamp.items()):
+                existing = set(ds.variables) & set(STATE_VARIABLES)
+                if existing >= set(variables):
+                    return ds
+            ds.close()
+        build_state(tfile, state_file, sorted(existing | set(variables)), temp, sal, mesh, None if mesh is None else depth_var, store)
+    raise Exception(f"Can't open the state of {tfile} with {' '.join(variables)} in {state_file}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("tfiles", metavar="T files", help="files of the potential temperature and practical salinity", type=str, nargs="+")
+    parser.add_argument("-var", dest="variables", metavar="variables", help=f"state variables ({' '.join(STATE_VARIABLES)}, default all)", type=str, nargs="+",
+                        choices=list(STATE_VARIABLES), default=list(STATE_VARIABLES))
+    parser.add_argument("-temp", dest="temp", metavar="temperature", help="potential temperature variable (default thetao_pot)", type=str, default="thetao_pot")
+    parser.add_argument("-sal", dest="sal", metavar="salinity", help="practical salinity variable (default so_pra)", type=str, default="so_pra")
+    parser.add_argument("-c", dest="store", metavar="store", help="directory of the store (default $WEIGHTS_STORE)", type=str, default=os.environ.get("WEIGHTS_STORE"))
+    args = parser.parse_args()
+
+    for tfile in args.tfiles:
+        with open_state(tfile, args.variables, args.temp, args.sal, store=args.store) as ds:
+            print(f"{tfile}: {ds.filepath()} ({' '.join(v for v in ds.variables if v in STATE_VARIABLES)})")
+
+
+if __name__=="__main__":
+    main()
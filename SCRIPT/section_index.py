@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+'''
+Geometry index of the sections of SECTIONS/ on a mesh.
+
+A section (section_LONLAT_*.dat: two end points, section_XTRAC_*.dat: a
+broken line) is drawn on the F points of the grid as a staircase going
+from one point to the next, as in cdftransport. Each step of the staircase
+crosses a U face (step along j) or a V face (step along i). The index of a
+section lists, along the staircase:
+
+    vtype       0 for a U face, 1 for a V face
+    j, i        the velocity point of each face
+    sign        +1/-1 so that sign*velocity is the flow to the right of the
+                section (going from its first point to its last one)
+    e_h         width of the faces (e2u or e1v)
+    e3, mask    thickness (e3u_0 or e3v_0) and mask of the faces, nz x faces
+    jt, it      the two T points on both sides of each face, 2 x faces
+    lon, lat    position of the faces
+
+with the boxes and flat indices in the boxes of the U, V and T points
+(util.region_gather), so that the fields of a section are gathered from
+the U/V/T files by reading only these boxes (gather_section).
+
+Indexes are kept in a store keyed by the content of the mesh and of the
+section file ($WEIGHTS_STORE), so they are built once per mesh:
+
+    section_index.py -m mesh.nc [-mask mask.nc] [-d SECTIONS] [-s names...]
+'''
+
+import os
+import glob
+import argparse
+import numpy as np
+import netCDF4 as nc4
+from util import get_ij_from_lon_lat, region_gather, get_file_hash, get_cache_key, cache_lookup
+
+SECTION_VERSION = 1 # version of the section index, part of its store key
+
+# eORCA configurations by number of i points of the grid (as in mk_trp.bash)
+CONFIGS = {360: "eORCA1", 362: "eORCA1", 1440: "eORCA025", 1442: "eORCA025", 4320: "eORCA12", 4322: "eORCA12"}
+
+def get_config(mesh_file):
+    '''
+    eORCA configuration of a mesh, from the size of its x dimension.
+    '''
+    with nc4.Dataset(mesh_file) as ds:
+        nx = len(ds.dimensions["x"])
+    if nx not in CONFIGS:
+        raise Exception(f"Unknown configuration: {nx} points along x in {mesh_file}")
+    return CONFIGS[nx]
+
+def find_section_file(sections_dir, kind, name, config=None):
+    '''
+    Definition file of a section (kind "LONLAT" or "XTRAC"), the one of the
+    configuration first if there is one, as in mk_trp.bash.
+    '''
+    for suffix in ([f"_{config}"] if config else []) + [""]:
+        path = os.path.join(sections_dir, f"section_{kind}_{name}{suffix}.dat")
+        if os.path.exists(path):
+            return path
+    raise Exception(f"Can't find the {kind} definition file of section {name} in {sections_dir}")
+
+def read_section_file(path):
+    '''
+    Name, longitudes and latitudes of the points of a section file:
+    either "name / lon1 lon2 lat1 lat2 / EOF" (LONLAT, cdftransport) or
+    "name / number of points / lon lat per point" (XTRAC, cdf_xtrac_brokenline).
+    '''
+    with open(path) as f:
+        lines = [line.replace(",", " ").split() for line in f if line.strip()]
+    name = lines[0][0]
+    if len(lines[1]) >= 4:
+        lon1, lon2, lat1, lat2 = map(float, lines[1][:4])
+        return name, np.array([lon1, lon2]), np.array([lat1, lat2])
+    npts = int(lines[1][0])
+    points = np.array([[float(v) for v in line[:2]] for line in lines[2:2 + npts]])
+    return name, points[:, 0], points[:, 1]
+
+def get_staircase_ij(points_i, points_j):
+    '''
+    F points of the staircase joining the points (i, j) of a broken line:
+    between two points, the steps along i and along j are taken in the
+    order the straight line crosses the half-steps, steps along i first
+    on ties. Returns the j, i vectors of the staircase points.
+    '''
+    path_j, path_i = [np.asarray(points_j[:1])], [np.asarray(points_i[:1])]
+    for i1, j1, i2, j2 in zip(points_i[:-1], points_j[:-1], points_i[1:], points_j[1:]):
+        ni, nj = abs(i2 - i1), abs(j2 - j1)
+        tcross = np.concatenate([(np.arange(ni) + 0.5) / max(ni, 1), (np.arange(nj) + 0.5) / max(nj, 1)])
+        along_i = np.arange(ni + nj) < ni
+        along_i = along_i[np.argsort(tcross, kind="stable")]
+        path_i.append(i1 + np.cumsum(np.where(along_i, np.sign(i2 - i1), 0)))
+        path_j.append(j1 + np.cumsum(np.where(along_i, 0, np.sign(j2 - j1))))
+    return np.concatenate(path_j), np.concatenate(path_i)
+
+def get_faces(path_j, path_i):
+    '''
+    Faces crossed by the steps of a staircase of F points: type (0: U, 1: V),
+    j, i of the velocity point, sign of the flow to the right of the path,
+    and the T points on both sides.
+    '''
+    dj, di = np.diff(path_j), np.diff(path_i)
+    vtype = (di != 0).astype(np.int8)
+    # step from F(j,i) to F(j,i+1) crosses V(j,i+1), to F(j+1,i) crosses U(j+1,i),
+    # a step backwards crosses the face of the point it starts from
+    j = np.where(dj > 0, path_j[1:], path_j[:-1])
+    i = np.where(di > 0, path_i[1:], path_i[:-1])
+    sign = np.where(vtype == 1, -di, dj).astype(np.float64) # going east the right is south, going north it is east
+    jt = np.stack([j, np.where(vtype == 1, j + 1, j)])
+    it = np.stack([i, np.where(vtype == 1, i, i + 1)])
+    return vtype, j, i, sign, jt, it
+
+def get_box_index(j, i):
+    '''
+    Box (tuple of j, i slices) containing the points (j, i) and their flat
+    indices in the box (see util.region_gather).
+    '''
+    if len(j) == 0:
+        return (slice(0, 0), slice(0, 0)), np.zeros(0, dtype=np.int64)
+    box = (slice(int(j.min()), int(j.max()) + 1), slice(int(i.min()), int(i.max()) + 1))
+    return box, (j - box[0].start) * (box[1].stop - box[1].start) + (i - box[1].start)
+
+def build_section_index(mesh_files, section_file):
+    '''
+    Index of a section (see above) on the mesh, whose variables are read in
+    the first of mesh_files (e.g. mesh.nc, mask.nc) having them.
+    '''
+    datasets = [nc4.Dataset(f) for f in mesh_files]
+    def var(name):
+        return next(ds[name] for ds in datasets if name in ds.variables)
+
+    try:
+        name, lons, lats = read_section_file(section_file)
+        glamf, gphif = [np.asarray(var(name)[:]).reshape(var(name).shape[-2:]) for name in ("glamf", "gphif")]
+        points_j, points_i = get_ij_from_lon_lat(lons, lats, glamf, gphif)
+        path_j, path_i = get_staircase_ij(np.atleast_1d(points_i), np.atleast_1d(points_j))
+        vtype, j, i, sign, jt, it = get_faces(path_j, path_i)
+
+        nz = var("e3u_0").shape[-3]
+        nf = len(vtype)
+        index = dict(name=np.array(name), vtype=vtype, j=j, i=i, sign=sign, jt=jt, it=it, path_j=path_j, path_i=path_i,
+                     e_h=np.empty(nf), e3=np.empty((nz, nf)), mask=np.empty((nz, nf)), lon=np.empty(nf), lat=np.empty(nf))
+        for vt, grid, e_h in ((0, "u", "e2u"), (1, "v", "e1v")):
+            faces = np.flatnonzero(vtype == vt)
+            box, flat = get_box_index(j[faces], i[faces])
+            index[f"box_{grid}"] = np.array([[s.start, s.stop] for s in box])
+            index[f"index_{grid}"] = flat
+            index[f"faces_{grid}"] = faces
+            index["e_h"][faces] = region_gather(var(e_h), flat, box).reshape(-1)
+            index["e3"][:, faces] = region_gather(var(f"e3{grid}_0"), flat, box).reshape(nz, -1)
+            index["mask"][:, faces] = region_gather(var(f"{grid}mask"), flat, box).reshape(nz, -1)
+            index["lon"][faces] = region_gather(var(f"glam{grid}"), flat, box).reshape(-1)
+            index["lat"][faces] = region_gather(var(f"gphi{grid}"), flat, box).reshape(-1)
+        box, flat = get_box_index(jt.ravel(), it.ravel())
+        index["box_t"] = np.array([[s.start, s.stop] for s in box])
+        index["index_t"] = flat.reshape(jt.shape)
+    finally:
+        for ds in datasets:
+            ds.close()
+
+    index["mask"] = np.nan_to_num(index["mask"])
+    return index
+
+def load_section_index(mesh_files, section_file, store=None):
+    '''
+    Index of a section on a mesh, read from the store if it is there,
+    built (build_section_index) and kept in the store otherwise.
+    '''
+    if not store:
+        return build_section_index(mesh_files, section_file)
+
+    os.makedirs(store, exist_ok=True)
+    key = get_cache_key([get_file_hash(f, store) for f in mesh_files], get_file_hash(section_file, store), "section", SECTION_VERSION)
+    entry, hit = cache_lookup(store, key, ext=".npz")
+    if not hit:
+        index = build_section_index(mesh_files, section_file)
+        tmp_file = f"{entry}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_file, **index)
+        os.replace(tmp_file, entry)
+    with np.load(entry) as npz:
+        return {k: npz[k] for k in npz.files}
+
+def gather_section(field, index, grid):
+    '''
+    Values of a field at the faces of a section (grid "u", "v", or "uv" for
+    the velocity normal to the faces from a (u, v) pair of fields, positive
+    to the right of the section) or at the T points on both sides of the
+    faces (grid "t"). Only the boxes of the section points are read.
+
+    Returns a float64 array (leading dims of the field..., faces), or
+    (leading dims..., 2, faces) for "t", masked values as NaN.
+    '''
+    box = lambda g: tuple(slice(*b) for b in index[f"box_{g}"])
+    if grid == "t":
+        flat = index["index_t"]
+        return region_gather(field, flat.ravel(), box("t")).reshape(field.shape[:-2] + flat.shape)
+    if grid == "uv":
+        u, v = gather_section(field[0], index, "u"), gather_section(field[1], index, "v")
+        return (u + v) * index["sign"]
+
+    faces = index[f"faces_{grid}"]
+    values = np.zeros(field.shape[:-2] + (len(index["vtype"]),))
+    values[..., faces] = region_gather(field, index[f"index_{grid}"], box(grid))
+    return values
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", dest="mesh", metavar="mesh file", help="mesh file (default mesh.nc)", type=str, default="mesh.nc")
+    parser.add_argument("-mask", dest="mask", metavar="mask file", help="file of umask and vmask if not in the mesh file (default mask.nc)", type=str, default="mask.nc")
+    parser.add_argument("-d", dest="sections_dir", metavar="sections directory", help="directory of the section files (default SECTIONS of the repository)", type=str,
+                        default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "SECTIONS"))
+    parser.add_argument("-s", dest="sections", metavar="sections", help="names of the sections (default all the sections of the directory)", type=str, nargs="+")
+    parser.add_argument("-k", dest="kinds", metavar="kinds", help="kinds of section files (default LONLAT XTRAC)", type=str, nargs="+", default=["LONLAT", "XTRAC"])
+    parser.add_argument("-c", dest="store", metavar="store", help="directory of the store (default $WEIGHTS_STORE)", type=str, default=os.environ.get("WEIGHTS_STORE"))
+    args = parser.parse_args()
+    if not args.store:
+        parser.error("a store is required: -c or $WEIGHTS_STORE")
+
+    mesh_files = [args.mesh] + ([args.mask] if os.path.exists(args.mask) and args.mask != args.mesh else [])
+    config = get_config(args.mesh)
+    for kind in args.kinds:
+        names = args.sections or sorted({os.path.basename(f)[len(f"section_{kind}_"):-4].removesuffix(f"_{config}")
+                                         for f in glob.glob(os.path.join(args.sections_dir, f"section_{kind}_*.dat"))
+                                         if not any(os.path.basename(f).endswith(f"_{c}.dat") for c in set(CONFIGS.values()) - {config})})
+        for name in names:
+            try:
+                section_file = find_section_file(args.sections_dir, kind, name, config)
+            except Exception as e:
+                print(e)
+                continue
+            index = load_section_index(mesh_files, section_file, args.store)
+            print(f"{kind:6s} {name:40s} {len(index['vtype']):5d} faces ({config})")
+
+
+if __name__=="__main__":
+    main()
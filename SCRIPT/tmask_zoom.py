@@ -1,11 +1,13 @@
 import xarray as xr # 2025.1.2
 import numpy as np # 2.2.3
-import scipy.ndimage as ndimage # 1.15.2
 import argparse # 1.1
-from util import get_ij_from_lon_lat
+from util import get_ij_from_lon_lat, label_regions, get_orca_topology, write_tmask
 
 
-def load_argument():
+TMASK_VERSION = 3 # version of the tmask generation, part of the tmask cache key (see gen_tmasks.py)
+MESH_VARS = ('tmask', 'nav_lon', 'nav_lat', 'glamt', 'gphit', 'gdept_0', 'bathy_metry', 'jperio') # mesh variables used to build a tmask
+
+def load_argument(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("-W", "--west", dest="west", metavar="western limit", help="western limit of the domain", type=float, nargs=1, required=True)
     parser.add_argument("-E", "--east", dest="east", metavar="eastern limit", help="eastern limit of the domain", type=float, nargs=1, required=True)
@@ -18,8 +20,11 @@ def load_argument():
     parser.add_argument("-maxisobath", dest="max_isobath", metavar="isobath constraint", help="max isobath limit of the domain", type=float, nargs=1, required=False)
     parser.add_argument("-tlon, --target_lon", dest="target_lon", metavar="target longitude", help="longitude which should be present in the largest cluster", type=float, nargs=1, required=True)
     parser.add_argument("-tlat, --target_lat", dest="target_lat", metavar="target latitude", help="latitude which should be present in the largest cluster", type=float, nargs=1, required=True)
+    parser.add_argument("-cluster", dest="cluster", metavar="cluster selection", help="cluster kept on each level: 'largest' (default) or 'target', the one containing the target point", type=str, choices=["largest", "target"], default="largest", required=False)
+    parser.add_argument("-topology", dest="topology", metavar="grid topology", help="connectivity of the clusters: 'none' (default) within each 2D level, 'orca' also across the east-west periodicity and north fold of the grid (from jperio)", type=str, choices=["none", "orca"], default="none", required=False)
+    parser.add_argument("-fmt", dest="fmt", metavar="file format", help="'compact' (default): bounding box of the mask with its offsets, 'full': global mask (e.g. for CDFTOOLS)", type=str, choices=["compact", "full"], default="compact", required=False)
     parser.add_argument("-o, --outf", dest="outf", metavar="output file", help="name of output file", type=str, nargs=1, required=True)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if (args.min_depth or args.max_depth) and (args.min_isobath or args.max_isobath):
         parser.error("Specify either depth constraints (-mindepth/-maxdepth) OR isobath constraints (-minisobath/-maxisobath), not both.")
@@ -92,49 +97,101 @@ def filter_bathy_or_depth(array, mesh_data, args):
 
     return array.where(depth_mask, 0) 
 
-def filter_largest_cluster(array, args):
+def filter_largest_cluster(array, args, cyclic=False, nfold=None):
     """
-    Retains only the largest cluster of non-zero values for each 2D array representation of a vertical level.
+    Retains only one cluster of non-zero values for each 2D array representation of a vertical level:
+    the largest one or, with args.cluster == 'target', the one containing the target grid point.
+
+    All the levels are labelled in one batched call on a plain boolean array (see util.label_regions)
+    and the result is written back to the xarray object once at the end.
 
     Parameters:
     array (xr.array): Input 4D array with clusters of non-zero values.
-    TARGET_J (int): Target J coordinate.
-    TARGET_I (int): Target I coordinate.
+    args (argparse.Namespace): Arguments from the command line, with the target grid point
+                               (args.target_j, args.target_i) set by filter_lat_lon.
+    cyclic (bool): whether the grid is east-west periodic (default False, plain 2D labelling).
+    nfold (str): type of north-fold pivot of the grid ('T', 'F' or None, the default).
 
     Returns:
-    xr.array: 4D array with only the largest cluster of non-zero values retained.
+    xr.array: 4D array with only the selected cluster of non-zero values retained.
     """
+
+    cluster = getattr(args, 'cluster', None) or 'largest'
+    values = array.values
+    nlev = int(np.prod(values.shape[:-2])) # number of 2D slices, e.g. 1 x 75 time steps x levels
     
-    for t in range(array.shape[0]):
-        for olevel in range(array.shape[1]):
-            
-            labeled_array, num_features = ndimage.label(array[t,olevel,:,:], structure=ndimage.generate_binary_structure(2, 1)) # array of same shape as input array, where non-zero values are labeled with integers starting from 1, with each integer representing a different cluster. Structure option to allow for diagonal connections.
-            cluster_sizes = ndimage.sum_labels(array[t,olevel,:,:], labeled_array, range(1, num_features + 1))
+    labels, num_features = label_regions(values != 0, cyclic=cyclic, nfold=nfold) # array of same shape as input array, where non-zero values are labeled with integers starting from 1, each integer representing a different cluster of a given level.
+    if num_features == 0:
+        return array
+
+    labels_2d = labels.reshape(nlev, -1)
+    cluster_sizes = np.bincount(labels.ravel(), weights=values.ravel().astype(np.float64), minlength=num_features + 1) # sum of the values of each cluster
+    cluster_level = np.zeros(num_features + 1, dtype=np.int64)
+    cluster_level[labels_2d] = np.arange(nlev)[:, np.newaxis] # each cluster belongs to a single level
+
+    # Largest cluster of each level, ties broken in favour of the first cluster found
+    features = np.arange(1, num_features + 1)
+    order = np.lexsort((features, -cluster_sizes[1:], cluster_level[1:]))
+    levels, first = np.unique(cluster_level[1:][order], return_index=True)
+    selected = np.zeros(nlev, dtype=np.int64) # 0 for levels without any cluster
+    selected[levels] = features[order][first]
+
+    target_labels = labels[..., args.target_j, args.target_i].reshape(nlev)
+    if cluster == 'target':
+        for olevel in np.where((selected > 0) & (target_labels == 0))[0]:
+            print(f"WARNING: Target grid point (J={args.target_j}, I={args.target_i}) is not in any cluster in olevel={olevel % values.shape[-3]}, keeping the largest cluster.")
+        selected = np.where(target_labels > 0, target_labels, selected)
+    else:
+        for olevel in np.where((selected > 0) & (target_labels != selected))[0]:
+            print(f"WARNING: Target grid point (J={args.target_j}, I={args.target_i}) is outside the bounds of the largest cluster in olevel={olevel % values.shape[-3]}.")
 
-            if cluster_sizes.size == 0:
-                continue
-            
-            largest_cluster_mask = (labeled_array == np.argmax(cluster_sizes) + 1) # 1206 x 1440 array, boolean mask for the largest cluster
-            array[t,olevel,:,:] = array[t,olevel,:,:].where(largest_cluster_mask, 0) # 1 x 75 x 1206 x 1440 array, 0 for all values outside the largest cluster
+    keep = np.zeros(num_features + 1, dtype=bool)
+    keep[selected[selected > 0]] = True
 
-            if not largest_cluster_mask[args.target_j, args.target_i]:
-                print(f"WARNING: Target grid point (J={args.target_j}, I={args.target_i}) is outside the bounds of the largest cluster in olevel={olevel}.")
-            
-    return array
+    return array.copy(data=np.where(keep[labels], values, 0)) # 1 x 75 x 1206 x 1440 array, 0 for all values outside the selected cluster
 
 
-def main():
+def load_mesh(mesh_file):
+    """
+    Loads in memory the mesh variables needed to build a tmask.
 
-    args = load_argument()
-    mesh_data = xr.open_dataset(args.mesh[0])
+    Parameters:
+    mesh_file (str): Path of the mesh file.
+
+    Returns:
+    xr.Dataset: Mesh data restricted to the variables of MESH_VARS present in the file.
+    """
+    with xr.open_dataset(mesh_file) as ds:
+        mesh_data = ds[[var for var in MESH_VARS if var in ds.variables]].load()
+
+    return mesh_data
+
+def gen_tmask(mesh_data, args):
+    """
+    Builds the tmask of a domain.
+
+    Parameters:
+    mesh_data (xr.Dataset): Mesh data from the mesh file (see load_mesh), not modified.
+    args (argparse.Namespace): Arguments from the command line (see load_argument).
+
+    Returns:
+    xr.array: 75 x 1206 x 1440 array, 1 for ocean points of the domain, 0 elsewhere.
+    """
     tmask = mesh_data['tmask'] # 1 x 75 x 1206 x 1440 array, 1 for ocean, 0 for land
     masked_tmask = filter_lat_lon(tmask, mesh_data, args) # 1 x 75 x 1206 x 1440 array, 0 for all values outside the domain
     if (args.min_depth or args.max_depth or args.min_isobath or args.max_isobath):
         masked_tmask = filter_bathy_or_depth(masked_tmask, mesh_data, args) # 1 x 75 x 1206 x 1440 array, 0 for all values below the depth threshold
-    masked_tmask = filter_largest_cluster(masked_tmask, args) # 1 x 75 x 1206 x 1440 array, 0 for all values outside the largest cluster
-    masked_tmask = masked_tmask.squeeze() # 75 x 1206 x 1440 array, removes the first dimension
-    masked_tmask.to_netcdf(args.outf[0])
+    cyclic, nfold = get_orca_topology(mesh_data, cyclic=True) if getattr(args, 'topology', 'none') == 'orca' else (False, None)
+    masked_tmask = filter_largest_cluster(masked_tmask, args, cyclic=cyclic, nfold=nfold) # 1 x 75 x 1206 x 1440 array, 0 for all values outside the selected cluster
+    return masked_tmask.squeeze() # 75 x 1206 x 1440 array, removes the first dimension
+
+
+def main():
+
+    args = load_argument()
+    mesh_data = load_mesh(args.mesh[0])
+    masked_tmask = gen_tmask(mesh_data, args)
+    write_tmask(masked_tmask, args.outf[0], fmt=args.fmt)
 
 if __name__=="__main__":
     main()
-
@@ -1,12 +1,26 @@
 #!/usr/bin/env python
 
 from typing import Tuple
+import os
+import json
+import hashlib
 import numpy as np
 import netCDF4 as nc4
 import xarray as xr
 import scipy.spatial as sp
+import scipy.ndimage as ndimage
+import scipy.sparse as sparse
+import scipy.sparse.csgraph as csgraph
 from xarray import Dataset, DataArray 
-from matplotlib import pyplot as plt
+
+# Number of nearest neighbours returned by each KD-tree query: enough to
+# catch the duplicated points of the ORCA east-west halo and north-fold.
+_NTIES = 8
+
+# KD-trees of model grids, built once per mesh (see get_grid_tree),
+# the most recently used ones last, at most _MAX_GRID_TREES of them
+_GRID_TREES = {}
+_MAX_GRID_TREES = 4
 
 #===================================================================================================
 def get_ij_from_lon_lat(LON, LAT, lon, lat):
@@ -15,23 +29,91 @@ def get_ij_from_lon_lat(LON, LAT, lon, lat):
     grid point i/j to a given lat/lon.
 
     Syntax:
-    i, j = get_ij_from_lon_lat(LON, LAT, lon, lat)
+    j, i = get_ij_from_lon_lat(LON, LAT, lon, lat)
    
-    LON, LAT: target longitude and latitude
+    LON, LAT: target longitude and latitude, either scalars
+              or vectors of equal length for batched queries
+    lon, lat: 2D arrays of model grid's longitude and latidtude
+
+    The search is done on the cached KD-tree of the model grid
+    returned by get_grid_tree, so each query costs O(log N).
+    When several grid points are at the same distance from the 
+    target (e.g. duplicated halo points), to a relative tolerance
+    of 1e-12, the one with the smallest i (and then smallest j) 
+    is returned.
+    If LON and LAT are scalars, j and i are scalars, otherwise
+    they are vectors of the same length as LON and LAT.
+    '''
+
+    nj, ni = np.shape(lon)
+    tree = get_grid_tree(lon, lat)
+
+    scalar = np.ndim(LON) == 0 and np.ndim(LAT) == 0
+    pnts = lonlat2xyz(np.atleast_1d(LON), np.atleast_1d(LAT))
+
+    k = min(_NTIES, tree.n)
+    dist, indx = tree.query(pnts, k=k)
+    dist = dist.reshape(len(pnts), k)
+    indx = indx.reshape(len(pnts), k)
+
+    # Tie-breaking: among the equidistant nearest points
+    # keep the one with the smallest i, then smallest j
+    find_j, find_i = np.unravel_index(indx, (nj, ni))
+    rank = np.where(np.isclose(dist, dist[:, :1], rtol=1e-12, atol=0), find_i * nj + find_j, nj * ni)
+    best = np.argmin(rank, axis=1)
+
+    j_indx = find_j[np.arange(len(pnts)), best]
+    i_indx = find_i[np.arange(len(pnts)), best]
+
+    if scalar:
+       return j_indx[0], i_indx[0]
+    return j_indx, i_indx
+
+def get_grid_tree(lon, lat):
+    '''
+    This function returns a KD-tree of the model grid points,
+    built on 3D unit vectors so that chord distances order the
+    points exactly as great-circle distances do.
+
+    Trees are cached per grid, keyed by the memory of the lon and lat
+    arrays (address, shape, strides and type, so views of the same 
+    data share a tree) at no cost over the size of the grid: repeated 
+    lookups on the same arrays only pay the build cost once. The
+    arrays are kept with their tree, and must not be modified in place.
+    Only the _MAX_GRID_TREES most recently used trees are kept.
+
+    Syntax:
+    tree = get_grid_tree(lon, lat)
+
     lon, lat: 2D arrays of model grid's longitude and latidtude
     '''
+    lon = np.asarray(lon)
+    lat = np.asarray(lat)
 
-    dist = hvrsn_dst(LON, LAT, lon, lat)
+    key = tuple((a.__array_interface__['data'][0], a.shape, a.strides, a.dtype.str) for a in (lon, lat))
 
-    min_dist = np.amin(dist)
+    if key in _GRID_TREES:
+       entry = _GRID_TREES.pop(key)
+    else:
+       xyz = lonlat2xyz(lon.ravel(), lat.ravel())
+       entry = (sp.cKDTree(xyz), lon, lat)
+       while len(_GRID_TREES) >= _MAX_GRID_TREES:
+           _GRID_TREES.pop(next(iter(_GRID_TREES)))
+    _GRID_TREES[key] = entry # most recently used last
 
-    find_min = np.where(dist == min_dist)
-    sort_j = np.argsort(find_min[1])
+    return entry[0]
 
-    j_indx = find_min[0][sort_j]
-    i_indx = find_min[1][sort_j]
+def lonlat2xyz(lon, lat):
+    '''
+    This function converts longitudes and latitudes (in degrees)
+    into an (N, 3) array of cartesian coordinates on the unit sphere.
+    '''
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
 
-    return j_indx[0], i_indx[0]
+    return np.stack((np.cos(lat) * np.cos(lon),
+                     np.cos(lat) * np.sin(lon),
+                     np.sin(lat)), axis=-1)
 
 def hvrsn_dst(lon1, lat1, lon2, lat2):
     '''
@@ -71,7 +153,7 @@ def hvrsn_dst(lon1, lat1, lon2, lat2):
     return dist
 
 #=======================================================================================
-def floodfill(field,j,i,checkValue,newValue):
+def floodfill(field,j,i,checkValue,newValue,cyclic=False,nfold=None):
     '''
     This is a modified version of the original algorithm:
 
@@ -82,6 +164,12 @@ def floodfill(field,j,i,checkValue,newValue):
        is not checkValue and is not newValue.
        N.B. if a point with initial value = to newValue is met, then the
             flooding stops. 
+    3) cyclic and nfold describe the topology of the grid (east-west
+       periodicity and ORCA north-fold pivot), see label_regions.
+       By default the flooding stops at the borders of the array.
+
+    The flooding is done in one pass by labelling the connected
+    regions of the field (see label_regions).
 
     Example:
 
@@ -104,27 +192,99 @@ def floodfill(field,j,i,checkValue,newValue):
                [0, 0, 0, 0, 0, 0, 0, 0, 0]])
 
     '''
-    Field = np.copy(field)
+    Field = np.array(field, copy=True)
 
-    theStack = [ (j, i) ]
+    if Field[j,i] == checkValue or Field[j,i] == newValue:
+       return Field
 
-    while len(theStack) > 0:
-          try:
-              j, i = theStack.pop()
-              if Field[j,i] == checkValue:
-                 continue
-              if Field[j,i] == newValue:
-                 continue
-              Field[j,i] = newValue
-              theStack.append( (j, i + 1) )  # right
-              theStack.append( (j, i - 1) )  # left
-              theStack.append( (j + 1, i) )  # down
-              theStack.append( (j - 1, i) )  # up
-          except IndexError:
-              continue # bounds reached
+    # Flooding is done on the 4-connected component of the
+    # points that are neither checkValue nor newValue
+    region = (Field != checkValue) & (Field != newValue)
+    labels, _ = label_regions(region, cyclic=cyclic, nfold=nfold)
+    Field[labels == labels[j,i]] = newValue
 
     return Field
 
+#=======================================================================================
+def label_regions(mask, cyclic=False, nfold=None):
+    '''
+    This function labels the 4-connected regions of the True points
+    of mask, optionally accounting for the topology of ORCA grids.
+
+    Syntax:
+    labels, nlabels = label_regions(mask, cyclic=False, nfold=None)
+
+    Input:
+    mask:   boolean array. Labelling is done on the last two
+            dimensions (j, i), leading dimensions (e.g. levels)
+            are labelled independently in the same call.
+    cyclic: if True, the first and the last column are connected
+            (east-west periodicity).
+    nfold:  None, "T" or "F": type of pivot of the ORCA north-fold.
+            The duplicated points of the last row(s) are connected 
+            to the points they are folded onto.
+    Output:
+    labels:  integer array of the same shape as mask, 0 for the
+             background and 1..nlabels for the regions.
+    nlabels: number of regions.
+    '''
+    mask = np.asarray(mask, dtype=bool)
+
+    # 4-connectivity on the (j, i) plane only
+    structure = np.zeros((3,) * mask.ndim, dtype=bool)
+    structure[(1,) * (mask.ndim - 2)] = ndimage.generate_binary_structure(2, 1)
+    labels, nlabels = ndimage.label(mask, structure=structure)
+
+    if nlabels == 0 or not (cyclic or nfold):
+       return labels, nlabels
+
+    # Pairs of labels of points that are neighbours (or the same point)
+    # through the east-west periodicity and the north-fold
+    pairs_a = []
+    pairs_b = []
+    if cyclic:
+       pairs_a.append(labels[..., :, 0])
+       pairs_b.append(labels[..., :, -1])
+    if nfold == "T":
+       # T-point pivot: T(nj-1, i) = T(nj-3, ni-i)
+       pairs_a.append(labels[..., -1, 1:])
+       pairs_b.append(labels[..., -3, :0:-1])
+    elif nfold == "F":
+       # F-point pivot: T(nj-1, i) = T(nj-2, ni-1-i)
+       pairs_a.append(labels[..., -1, :])
+       pairs_b.append(labels[..., -2, ::-1])
+    elif nfold is not None:
+       raise ValueError(f"Unknown north-fold pivot '{nfold}', use 'T' or 'F'")
+
+    pairs_a = np.concatenate([p.ravel() for p in pairs_a])
+    pairs_b = np.concatenate([p.ravel() for p in pairs_b])
+    link = (pairs_a > 0) & (pairs_b > 0)
+
+    # Merge the linked labels and renumber them consecutively
+    graph = sparse.coo_matrix((np.ones(link.sum(), dtype=np.int8), (pairs_a[link], pairs_b[link])), 
+                              shape=(nlabels + 1, nlabels + 1))
+    _, comp = csgraph.connected_components(graph, directed=False)
+    _, new = np.unique(comp[1:], return_inverse=True)
+    lut = np.concatenate(([0], new + 1))
+
+    return lut[labels], int(new.max()) + 1
+
+def get_orca_topology(mesh, cyclic=False):
+    '''
+    This function returns the (cyclic, nfold) arguments of label_regions
+    and floodfill for a NEMO mesh, based on its jperio variable if present.
+    Without jperio, the grid has no fold and is east-west periodic
+    only if cyclic is True (e.g. for global masks).
+    '''
+    if "jperio" not in mesh:
+       return cyclic, None
+
+    jperio = int(np.asarray(mesh["jperio"]).ravel()[0])
+    cyclic = jperio in (1, 4, 6, 7)
+    nfold = {3: "T", 4: "T", 5: "F", 6: "F"}.get(jperio, None)
+
+    return cyclic, nfold
+
 # =====================================================================================================
 def get_poly_line_ij(points_i, points_j):
     '''
@@ -133,10 +293,12 @@ def get_poly_line_ij(points_i, points_j):
     Description:
     get_poly_line_ij takes a list of points (specified by 
     pairs of indexes i,j) and draws connecting lines between them 
-    using the Bresenham line-drawing algorithm.
+    using the Bresenham line-drawing algorithm. All the segments
+    are rasterised at once (see bresenham_lines) and the points
+    repeated at the junctions of consecutive segments are removed.
     
     Syntax:
-    line_i, line_j = get_poly_line_ij(points_i, points_i)
+    line_j, line_i = get_poly_line_ij(points_i, points_j)
     
     Input:
     points_i, points_j: vectors of equal length of pairs of i, j
@@ -144,62 +306,73 @@ def get_poly_line_ij(points_i, points_j):
                         points will be connected in the order they're given
                         in these vectors. 
     Output:
-    line_i, line_j: vectors of the same length as the points-vectors
-                    giving the i,j coordinates of the points on the
-                    rasterised lines. 
+    line_j, line_i: integer vectors giving the j,i coordinates 
+                    of the points on the rasterised lines, 
+                    contiguous and ordered from the first point 
+                    of the polyline to the last one. 
     '''
-    line_i=[]
-    line_j=[]
-
-    line_n=0
+    points_i = np.asarray(points_i).astype(np.int64).ravel()
+    points_j = np.asarray(points_j).astype(np.int64).ravel()
 
     if len(points_i) == 1:
-       line_i = points_i
-       line_j = points_j
-    else:
-       for fi in np.arange(len(points_i)-1):
-           # start point of line
-           i1 = points_i[fi]
-           j1 = points_j[fi]
-           # end point of line
-           i2 = points_i[fi+1]
-           j2 = points_j[fi+1]
-           # 'draw' line from i1,j1 to i2,j2
-           pj, pi = bresenham_line(i1,i2,j1,j2)
-           if pi[0] != i1 or pj[0] != j1:
-              # beginning of line doesn't match end point, 
-              # so we flip both vectors
-              pi = np.flipud(pi)
-              pj = np.flipud(pj)
-
-           plen = len(pi)
-
-           for PI in np.arange(plen):
-               line_n = PI
-               if len(line_i) == 0 or line_i[line_n-1] != pi[PI] or line_j[line_n-1] != pj[PI]:
-                  line_i.append(int(pi[PI]))
-                  line_j.append(int(pj[PI]))
-
-
-    return line_j, line_i
+       return points_j, points_i
+
+    line_j, line_i, _ = bresenham_lines(points_i[:-1], points_i[1:],
+                                        points_j[:-1], points_j[1:])
+
+    # remove consecutive duplicates (i.e. the junctions between segments)
+    keep = np.ones(len(line_i), dtype=bool)
+    keep[1:] = (line_i[1:] != line_i[:-1]) | (line_j[1:] != line_j[:-1])
+
+    return line_j[keep], line_i[keep]
+
+def get_section_line_ij(lons, lats, lon, lat):
+    '''
+    Syntax:
+    line_j, line_i = get_section_line_ij(lons, lats, lon, lat)
+
+    Input:
+    lons, lats: longitudes and latitudes of the points defining
+                a broken-line section (e.g. the points listed in
+                the SECTIONS/section_XTRAC_*.dat files)
+    lon, lat:   2D arrays of model grid's longitude and latidtude
+
+    The points are located on the model grid with one batched 
+    query of get_ij_from_lon_lat and the whole broken line is 
+    then rasterised at once with get_poly_line_ij.
+    '''
+    points_j, points_i = get_ij_from_lon_lat(np.asarray(lons, dtype=np.float64),
+                                             np.asarray(lats, dtype=np.float64),
+                                             lon, lat)
+
+    return get_poly_line_ij(points_i, points_j)
 
 #=======================================================================================
-def get_poly_area_ij(points_i, points_j, a_ji):
+def get_poly_area_ij(points_i, points_j, a_ji, mask=False):
     '''
     Syntax:
     area_j, area_i = get_poly_area_ij(points_i, points_j, a_ji)
+    area_msk = get_poly_area_ij(points_i, points_j, a_ji, mask=True)
 
     Input:
     points_i, points_j: j,i indexes of the the points
                         defining the polygon
     a_ji: shape (i.e., (nj,ni)) of the 2d matrix from which points_i 
           and points_j are selected
+    mask: if True, return a boolean (nj,ni) mask of the area
+          instead of its j,i indexes
+
+    The area is made of the points of the rasterised boundary and of
+    the grid points whose centre is inside the polygon (even-odd rule).
+    It is computed with a vectorized scanline test limited to the index
+    bounding box of the polygon, so the cost scales with the size of 
+    the polygon and not with the size of the grid.
     '''
     [jpj, jpi] = a_ji
     pnt_i = np.array(points_i)
     pnt_j = np.array(points_j)
 
-    if (pnt_i[0] == pnt_i[-1]) and (pnt_i[0] == pnt_i[-1]):
+    if (pnt_i[0] == pnt_i[-1]) and (pnt_j[0] == pnt_j[-1]):
         # polygon is already closed
         i_indx = np.copy(pnt_i)
         j_indx = np.copy(pnt_j)
@@ -208,34 +381,48 @@ def get_poly_area_ij(points_i, points_j, a_ji):
         i_indx = np.append( pnt_i, pnt_i[0])
         j_indx = np.append( pnt_j, pnt_j[0])
 
-    [bound_j, bound_i] = get_poly_line_ij(i_indx, j_indx)
-
-    mask = np.zeros(shape=(jpj,jpi))
-    for n in range(len(bound_i)):
-        i         = bound_i[n]
-        j         = bound_j[n]
-        mask[j,i] = 1
-    corners_j = [ 0,   0, jpj, jpj ]
-    corners_i = [ 0, jpi,   0, jpi ]
-
-    for n in range(4):
-        j = corners_j[n]
-        i = corners_i[n]
-        if mask[j,i] == 0:
-           fill_i = i
-           fill_j = j
-           break
-
-    mask_filled = floodfill(mask,fill_j,fill_i,1,1)
-    for n in range(len(bound_i)):
-        j                = bound_j[n]
-        i                = bound_i[n]
-        mask_filled[j,i] = 0
-
-    # the points that are still 0 are within the required area
-    [area_j, area_i] = np.where(mask_filled == 0);
-
-    return area_j, area_i
+    # Index bounding box of the polygon, within the grid
+    j0 = max(int(np.min(j_indx)), 0)
+    j1 = min(int(np.max(j_indx)), jpj - 1)
+    i0 = max(int(np.min(i_indx)), 0)
+    i1 = min(int(np.max(i_indx)), jpi - 1)
+
+    box = np.zeros((max(j1 - j0 + 1, 0), max(i1 - i0 + 1, 0)), dtype=bool)
+
+    if box.size > 0:
+       # Scanline: crossings of each row of the box with each edge of the 
+       # polygon, using the half-open rule to count vertices only once
+       rows = np.arange(j0, j1 + 1, dtype=np.float64)[:, np.newaxis]
+       cols = np.arange(i0, i1 + 1, dtype=np.float64)
+       ya = j_indx[:-1].astype(np.float64)
+       yb = j_indx[1:].astype(np.float64)
+       xa = i_indx[:-1].astype(np.float64)
+       xb = i_indx[1:].astype(np.float64)
+
+       crossing = ((ya <= rows) & (rows < yb)) | ((yb <= rows) & (rows < ya))
+       with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = xa + (rows - ya) * (xb - xa) / (yb - ya)
+       x_cross = np.where(crossing, x_cross, np.inf)  # nrows x nedges
+
+       # Even-odd rule: points with an odd number of crossings on their left
+       n_left = (x_cross[:, np.newaxis, :] < cols[np.newaxis, :, np.newaxis]).sum(axis=2)
+       box = (n_left % 2) == 1
+
+       # The rasterised boundary is part of the area
+       [bound_j, bound_i] = get_poly_line_ij(i_indx, j_indx)
+       bound_j = np.asarray(bound_j)
+       bound_i = np.asarray(bound_i)
+       inbox = (bound_j >= j0) & (bound_j <= j1) & (bound_i >= i0) & (bound_i <= i1)
+       box[bound_j[inbox] - j0, bound_i[inbox] - i0] = True
+
+    if mask:
+       area_msk = np.zeros((jpj, jpi), dtype=bool)
+       area_msk[j0:j0 + box.shape[0], i0:i0 + box.shape[1]] = box
+       return area_msk
+
+    [area_j, area_i] = np.nonzero(box)
+
+    return area_j + j0, area_i + i0
 
 # =====================================================================================================
 def bresenham_line(x0, x1, y0, y1):
@@ -247,59 +434,523 @@ def bresenham_line(x0, x1, y0, y1):
     between two points. Taken from the generalised algotihm on
 
     http://en.wikipedia.org/wiki/Bresenham%27s_line_algorithm
+
+    As in the original algorithm, the points are returned ordered
+    along increasing values of the main axis of the line.
     '''
 
+    pj, pi, _ = bresenham_lines(x0, x1, y0, y1)
+
     steep = abs(y1 - y0) > abs(x1 - x0)
+    if (steep and y0 > y1) or (not steep and x0 > x1):
+       pj = pj[::-1]
+       pi = pi[::-1]
+
+    return pj.astype(np.float64), pi.astype(np.float64)
+
+def bresenham_lines(x0, x1, y0, y1):
+    '''
+    Vectorized Bresenham algorithm for a batch of segments
+    point0 = (y0, x0) -> point1 = (y1, x1), with x0, x1, y0, y1 
+    scalars or vectors of equal length.
+
+    Syntax:
+    pj, pi, npts = bresenham_lines(x0, x1, y0, y1)
+
+    Output:
+    pj, pi: integer vectors with the points of all the segments,
+            one segment after the other, each of them going from 
+            point0 to point1.
+    npts:   number of points of each segment.
+
+    The points are the same as the ones selected by the iterative 
+    algorithm: along the main axis of the segment (the one with the
+    largest extent) the line is drawn starting from the end with the 
+    smallest coordinate, and the k-th point is offset along the 
+    other axis by floor(k * delta_minor / delta_major + 1/2), 
+    computed here with integer arithmetic. On exact half-point ties
+    the iterative algorithm goes one way or the other depending on 
+    the rounding of its accumulated error, so the segments with ties
+    are replayed step by step (all of them at once) to keep its choice.
+    '''
+    x0 = np.atleast_1d(np.asarray(x0)).astype(np.int64)
+    x1 = np.atleast_1d(np.asarray(x1)).astype(np.int64)
+    y0 = np.atleast_1d(np.asarray(y0)).astype(np.int64)
+    y1 = np.atleast_1d(np.asarray(y1)).astype(np.int64)
+
+    steep = np.abs(y1 - y0) > np.abs(x1 - x0)
+
+    # main (a) and secondary (b) axis of each segment
+    a0 = np.where(steep, y0, x0)
+    a1 = np.where(steep, y1, x1)
+    b0 = np.where(steep, x0, y0)
+    b1 = np.where(steep, x1, y1)
+
+    # lines are drawn from the end with the smallest main coordinate
+    swap = a0 > a1
+    a_s = np.where(swap, a1, a0)
+    b_s = np.where(swap, b1, b0)
+    b_e = np.where(swap, b0, b1)
+
+    delta_a = np.abs(a1 - a0)
+    delta_b = np.abs(b_e - b_s)
+    b_step = np.where(b_s < b_e, 1, -1)
+
+    # one entry per point: segment it belongs to and 
+    # position along the segment starting from point0
+    npts = delta_a + 1
+    seg = np.repeat(np.arange(len(npts)), npts)
+    k = np.arange(npts.sum()) - np.repeat(np.cumsum(npts) - npts, npts)
+    k = np.where(swap[seg], delta_a[seg] - k, k)
+
+    a = a_s[seg] + k
+    b = b_s[seg] + b_step[seg] * ((2 * k * delta_b[seg] + delta_a[seg]) // 
+                                  (2 * np.maximum(delta_a[seg], 1)))
+
+    # segments with ties: offsets from the error accumulated 
+    # in floating point, as in the iterative algorithm
+    tie = (delta_a[seg] > 0) & ((2 * k * delta_b[seg] + delta_a[seg]) % 
+                                (2 * np.maximum(delta_a[seg], 1)) == 0)
+    tied = np.unique(seg[tie])
+    if tied.size > 0:
+       deltaerr = delta_b[tied] / delta_a[tied]
+       error = np.zeros(len(tied))
+       offset = np.zeros((len(tied), delta_a[tied].max() + 1), dtype=np.int64)
+       for c in range(delta_a[tied].max()):
+           error = error + deltaerr
+           step = error >= 0.5
+           offset[:, c + 1] = offset[:, c] + step
+           error = np.where(step, error - 1.0, error)
+       in_tied = np.isin(seg, tied)
+       row = np.searchsorted(tied, seg[in_tied])
+       b[in_tied] = b_s[seg[in_tied]] + b_step[seg[in_tied]] * offset[row, k[in_tied]]
+
+    pi = np.where(steep[seg], b, a)
+    pj = np.where(steep[seg], a, b)
+
+    return pj, pi, npts
+
+# =====================================================================================================
+def tmask_bounds(mask):
+    '''
+    This function returns the bounding box of the non-zero values
+    of an N-d mask as a tuple of slices (one per dimension), e.g.
+    (kslice, jslice, islice) for a nk x nj x ni tmask.
+    An empty mask gives slices of size 0 starting at 0.
+    '''
+    mask = np.asarray(mask) != 0
+    box = []
+    for axis in range(mask.ndim):
+        proj = np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        box.append(slice(int(proj[0]), int(proj[-1]) + 1) if proj.size else slice(0, 0))
+    return tuple(box)
+
+def write_tmask(tmask, outfile, fmt="compact"):
+    '''
+    This function writes a 3D (nav_lev, y, x) tmask DataArray to outfile.
+
+    fmt = "full"   : the global mask as it is (as needed by CDFTOOLS)
+    fmt = "compact": only the bounding box of the ocean points, as a
+                     zlib-compressed int8 array, with the offsets of the
+                     box in the global grid (global attributes k0, j0, i0),
+                     the global shape (nk, nj, ni) and the number of ocean
+                     points of each level of the box (variable npts).
+    '''
+    if fmt == "full":
+       tmask.to_netcdf(outfile)
+       return
+
+    values = np.asarray(tmask.values) != 0
+    box = tmask_bounds(values)
+    if values.size and not values.any():
+       box = tuple(slice(0, 1) for _ in box)
+    cropped = values[box].astype(np.int8)
+
+    dims = tmask.dims
+    ds = xr.Dataset({"tmask": (dims, cropped, tmask.attrs),
+                     "npts" : (dims[:1], cropped.sum(axis=(1, 2)).astype(np.int32),
+                               {"long_name": "number of ocean points of each level"})})
+    ds.attrs = {"tmask_format": "compact",
+                "k0": box[0].start, "j0": box[1].start, "i0": box[2].start,
+                "nk": values.shape[0], "nj": values.shape[1], "ni": values.shape[2]}
+    ds.to_netcdf(outfile, encoding={"tmask": {"zlib": True, "complevel": 4}})
+
+def read_tmask(tmask_file):
+    '''
+    This function reads a tmask file written by write_tmask, in
+    either format (legacy full masks are also accepted).
+
+    Syntax:
+    mask, box, shape = read_tmask(tmask_file)
+
+    mask : nk x nj x ni int8 array of the mask in its bounding box
+    box  : tuple of (k, j, i) slices of the box in the global grid,
+           that can be used to hyperslab model fields directly
+    shape: global shape (nk, nj, ni) of the grid
+    '''
+    with xr.open_dataset(tmask_file, decode_times=False) as ds:
+         if ds.attrs.get("tmask_format") == "compact":
+            mask = ds["tmask"].values.astype(np.int8)
+            offsets = [int(ds.attrs[o]) for o in ("k0", "j0", "i0")]
+            shape = tuple(int(ds.attrs[n]) for n in ("nk", "nj", "ni"))
+            box = tuple(slice(o, o + n) for o, n in zip(offsets, mask.shape))
+         else:
+            full = np.asarray(ds["tmask"].values).squeeze()
+            shape = full.shape
+            box = tmask_bounds(full)
+            mask = (full[box] != 0).astype(np.int8)
+
+    return mask, box, shape
+
+def expand_tmask(mask, box, shape, window=None):
+    '''
+    This function returns the global int8 tmask of the given shape
+    from the mask of its bounding box (see read_tmask).
 
-    if steep:
-       # swap(x0, y0)
-       t  = y0
-       y0 = x0
-       x0 = t
-       # swap(x1, y1)    
-       t  = y1
-       y1 = x1
-       x1 = t
-
-    if x0 > x1:
-       # swap(x0, x1)
-       t  = x1
-       x1 = x0
-       x0 = t
-       # swap(y0, y1)
-       t  = y1
-       y1 = y0
-       y0 = t
-
-    deltax = np.fix(x1 - x0)
-    deltay = np.fix(abs(y1 - y0))
-    error  = 0.0
-
-    deltaerr = deltay / deltax
-    y = y0
-
-    if y0 < y1:
-       ystep = 1
+    Syntax:
+    tmask = expand_tmask(mask, box, shape, window=None)
+
+    window: tuple of slices of the global grid, only this part of the
+            global tmask is returned (default: the whole grid)
+    '''
+    if window is None:
+       window = (slice(None),) * len(shape)
+    window = [slice(*w.indices(n)[:2]) for w, n in zip(window, shape)]
+
+    full = np.zeros(tuple(w.stop - w.start for w in window), dtype=np.int8)
+    src, dst = [], []
+    for b, w in zip(box, window):
+        lo, hi = max(b.start, w.start), min(b.stop, w.stop)
+        hi = max(lo, hi)
+        src.append(slice(lo - b.start, hi - b.start))
+        dst.append(slice(lo - w.start, hi - w.start))
+    full[tuple(dst)] = mask[tuple(src)]
+    return full
+
+# =====================================================================================================
+def get_region_index(mask):
+    '''
+    This function returns the sparse representation of a region:
+    the sorted flat indices of the non-zero points of its mask
+    (e.g. the bounding-box mask returned by read_tmask).
+
+    Syntax:
+    index = get_region_index(mask)
+
+    Reductions over the region then gather only these points
+    (region_gather) instead of masking global arrays.
+    '''
+    return np.flatnonzero(np.asarray(mask))
+
+def read_box(field, box):
+    '''
+    This function reads the hyperslab of a box of the grid from a field.
+
+    Syntax:
+    values = read_box(field, box)
+
+    field: array-like (numpy, netCDF4 variable, dask array, ...) whose
+           trailing dimensions are the grid dimensions of box. As in numpy
+           broadcasting, grid dimensions of size 1 or missing (e.g. e1t
+           for a 3D region) are broadcast.
+    box  : tuple of slices of the box in the global grid (read_tmask)
+
+    values: float64 array (leading dims of field..., box shape), with
+            masked values as NaN
+    '''
+    ngrid = min(len(box), len(field.shape))
+    fshape = tuple(field.shape[len(field.shape) - ngrid:])
+    slices = tuple(slice(0, 1) if n == 1 else b for n, b in zip(fshape, box[len(box) - ngrid:]))
+
+    sub = field[(Ellipsis,) + slices]
+    if hasattr(sub, "compute"):
+       sub = sub.compute()
+    sub = np.ma.filled(np.ma.asarray(sub).astype(np.float64), np.nan)
+
+    lead = sub.shape[:sub.ndim - ngrid]
+    box_shape = tuple(b.stop - b.start for b in box)
+    sub = sub.reshape(lead + (1,) * (len(box) - ngrid) + sub.shape[sub.ndim - ngrid:])
+    return np.broadcast_to(sub, lead + box_shape)
+
+def region_gather(field, index, box):
+    '''
+    This function returns the values of field at the points of a region.
+
+    Syntax:
+    values = region_gather(field, index, box)
+
+    field: array-like whose trailing dimensions are the grid dimensions
+           of box. Only the box is read (read_box), then the region points
+           are gathered.
+    index: flat indices of the region points in the box (get_region_index)
+    box  : tuple of slices of the box in the global grid (read_tmask)
+
+    values: float64 array (leading dims of field..., npts), with masked
+            values as NaN
+    '''
+    sub = read_box(field, box)
+    lead = sub.shape[:sub.ndim - len(box)]
+    return sub.reshape(lead + (-1,))[..., index]
+
+def union_box(boxes):
+    '''
+    This function returns the smallest box containing all the given
+    boxes (tuples of slices of the global grid, see read_tmask), e.g. to
+    read once the hyperslab needed by several regions.
+    '''
+    return tuple(slice(min(b.start for b in bs), max(b.stop for b in bs)) for bs in zip(*boxes))
+
+def region_reduce(values, weights=None, aggr="mean", total=None):
+    '''
+    This function reduces the gathered values of a region
+    (see region_gather) over the region points, ignoring NaNs.
+
+    Syntax:
+    result = region_reduce(values, weights=None, aggr="mean", total=None)
+
+    values : array (..., npts)
+    weights: array broadcastable to values (e.g. e1t*e2t*e3t gathered
+             at the region points), only used by aggr="mean"
+    aggr   : "mean" (weighted mean as a dot product), "min" or "max"
+    total  : sum of the (non-NaN) weights over the region, if known, used
+             as the normalisation of the mean when all the values are valid
+
+    result: array (...), NaN where no point is valid
+    '''
+    valid = ~np.isnan(values)
+
+    if aggr == "mean":
+       wgts = np.ones(values.shape[-1]) if weights is None else weights
+       wgts = np.where(valid & ~np.isnan(wgts), wgts, 0.)
+       total_values = np.einsum("...n,...n->...", wgts, np.where(valid, values, 0.))
+       norm = total if total is not None and valid.all() else wgts.sum(axis=-1)
+       with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(norm > 0, total_values / norm, np.nan)
+
+    if aggr == "min":
+       result = np.where(valid, values, np.inf).min(axis=-1, initial=np.inf)
+    elif aggr == "max":
+       result = np.where(valid, values, -np.inf).max(axis=-1, initial=-np.inf)
     else:
-       ystep = -1
-
-    c=0
-    pi = np.zeros(shape=[x1-x0+1])
-    pj = np.zeros(shape=[x1-x0+1])
-    for x in np.arange(x0,x1+1) :
-        if steep:
-           pi[c]=y
-           pj[c]=x
+       raise ValueError(f"Unknown aggregator {aggr}")
+
+    return np.where(valid.any(axis=-1), result, np.nan)
+
+def region_stats(values, weights=None, stats=("mean",), total=None):
+    '''
+    This function computes several statistics of the gathered values of a
+    region (see region_gather) over the region points, ignoring NaNs, from
+    a single read of the values.
+
+    Syntax:
+    results = region_stats(values, weights=None, stats=("mean",), total=None)
+
+    values : array (..., npts)
+    weights: array broadcastable to values, used by the mean, the variance,
+             the standard deviation and the percentiles
+    stats  : "mean", "var", "std", "min", "max", "minloc", "maxloc" or
+             "p<q>" (weighted q-th percentile, e.g. "p90", interpolated
+             between the mid-points of the cumulated weights of the sorted
+             values)
+    total  : sum of the weights over the region, if known (see region_reduce)
+
+    results: dict of the array (...) of each statistic, NaN where no point is
+             valid. For minloc and maxloc, (value, index) where index is the
+             index of the min/max among the region points (-1 if none is valid).
+    '''
+    valid = ~np.isnan(values)
+    any_valid = valid.any(axis=-1)
+    wgts = np.ones(values.shape[-1]) if weights is None else weights
+    wgts = np.broadcast_to(np.where(valid & ~np.isnan(wgts), wgts, 0.), values.shape)
+
+    results = {}
+    for stat in stats:
+        if stat in ("mean", "min", "max"):
+           results[stat] = region_reduce(values, weights, stat, total)
+
+        elif stat in ("var", "std"):
+           if "mean" not in results:
+              results["mean"] = region_reduce(values, weights, "mean", total)
+           dev = np.where(valid, values - results["mean"][..., np.newaxis], 0.)
+           norm = wgts.sum(axis=-1)
+           with np.errstate(invalid="ignore", divide="ignore"):
+                var = np.where(norm > 0, np.einsum("...n,...n->...", wgts, dev * dev) / norm, np.nan)
+           results[stat] = var if stat == "var" else np.sqrt(var)
+
+        elif stat in ("minloc", "maxloc"):
+           fill = np.inf if stat == "minloc" else -np.inf
+           filled = np.where(valid, values, fill)
+           index = filled.argmin(axis=-1) if stat == "minloc" else filled.argmax(axis=-1)
+           value = np.take_along_axis(filled, index[..., np.newaxis], axis=-1)[..., 0]
+           results[stat] = (np.where(any_valid, value, np.nan), np.where(any_valid, index, -1))
+
+        elif stat.startswith("p"):
+           q = float(stat[1:]) / 100.
+           order = np.argsort(np.where(valid, values, np.inf), axis=-1)
+           sorted_values = np.take_along_axis(values, order, axis=-1).reshape(-1, values.shape[-1])
+           sorted_wgts = np.take_along_axis(wgts, order, axis=-1).reshape(-1, values.shape[-1])
+           nvalid = valid.sum(axis=-1).ravel()
+           result = np.full(len(nvalid), np.nan)
+           for n, (v, w, nv) in enumerate(zip(sorted_values, sorted_wgts, nvalid)):
+               cw = np.cumsum(w[:nv])
+               if nv > 0 and cw[-1] > 0:
+                  result[n] = np.interp(q, (cw - 0.5 * w[:nv]) / cw[-1], v[:nv])
+           results[stat] = result.reshape(values.shape[:-1])
+
         else:
-           pi[c]=x
-           pj[c]=y
-        error = error + deltaerr
-        if error >= 0.5:
-           y = y + ystep
-           error = error - 1.0
-        c += 1
-
-    return pj, pi
+           raise ValueError(f"Unknown statistic {stat}")
+
+    return {stat: results[stat] for stat in stats}
+
+# =====================================================================================================
+def get_file_hash(path, cache_dir=None):
+    '''
+    This function returns the blake2b hash of the content of a file.
+
+    Syntax:
+    fhash = get_file_hash(path, cache_dir=None)
+
+    If cache_dir is given, hashes are memoised in cache_dir/file_hashes.json
+    keyed by the real path, size and modification time of the file, so
+    that a large mesh_mask is only read again when it changes.
+    '''
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    key = f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    index = {}
+    if cache_dir:
+       index_file = os.path.join(cache_dir, "file_hashes.json")
+       if os.path.exists(index_file):
+          with open(index_file) as f:
+               index = json.load(f)
+       if key in index:
+          return index[key]
+
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+         for block in iter(lambda: f.read(1 << 24), b""):
+             h.update(block)
+    fhash = h.hexdigest()
+
+    if cache_dir:
+       index = {k: v for k, v in index.items() if not k.startswith(path + ":")}
+       index[key] = fhash
+       tmp_file = f"{index_file}.{os.getpid()}"
+       with open(tmp_file, "w") as f:
+            json.dump(index, f, indent=2)
+       os.replace(tmp_file, index_file)
+
+    return fhash
+
+def get_cache_key(*items):
+    '''
+    This function returns a hash identifying a cache entry from
+    json-serialisable items (e.g. a file hash and a parameter dict,
+    whose keys are sorted so that their order does not matter).
+    '''
+    h = hashlib.blake2b(json.dumps(items, sort_keys=True, default=str).encode(), digest_size=16)
+    return h.hexdigest()
+
+def cache_lookup(cache_dir, key, ext=".nc"):
+    '''
+    This function returns (path, hit) for a cache entry: the path of
+    cache_dir/<key><ext> and whether it already exists. On a hit the
+    entry modification time is updated, since prune_cache evicts the
+    least recently used entries first.
+    '''
+    path = os.path.join(cache_dir, key + ext)
+    hit = os.path.exists(path)
+    if hit:
+       os.utime(path)
+    return path, hit
+
+def link_cache_entry(entry, path):
+    '''
+    This function makes path a symbolic link to the cache entry,
+    replacing any file or link already there.
+    '''
+    if os.path.lexists(path):
+       os.remove(path)
+    os.symlink(os.path.realpath(entry), path)
+
+def prune_cache(cache_dir, max_size, ext=".nc", keep=(), prefix="", link_dirs=()):
+    '''
+    This function removes the least recently used entries of
+    cache_dir (files starting with prefix and ending with ext) until
+    their total size is below max_size (in bytes). Entries listed in
+    keep (e.g. those linked by the current run) or pointed to by a
+    symbolic link of link_dirs (e.g. the run directories of all the
+    RUNIDs sharing the cache) are never removed. It returns the list
+    of removed files.
+    '''
+    keep = set(os.path.realpath(path) for path in keep)
+    for link_dir in link_dirs:
+        for name in os.listdir(link_dir):
+            path = os.path.join(link_dir, name)
+            if os.path.islink(path):
+               keep.add(os.path.realpath(path))
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(prefix) and name.endswith(ext) and os.path.isfile(path):
+           stat = os.stat(path)
+           entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+           break
+        if os.path.realpath(path) in keep:
+           continue
+        os.remove(path)
+        total -= size
+        removed.append(path)
+
+    return removed
+
+def store_array(cache_dir, key, compute):
+    '''
+    This function returns a stored array as a read-only memory map.
+
+    Syntax:
+    array = store_array(cache_dir, key, compute)
+
+    On a miss, the array is computed by compute() and stored as
+    cache_dir/<key>.npy (float64, masked values as NaN), e.g. the
+    static weights of a mesh (see reduce_fields.py). Only the parts
+    of the array that are used are then read from disk.
+    '''
+    entry, hit = cache_lookup(cache_dir, key, ext=".npy")
+    if not hit:
+       array = np.ma.filled(np.ma.asarray(compute()).astype(np.float64), np.nan)
+       tmp_file = f"{entry}.{os.getpid()}.tmp.npy"
+       np.save(tmp_file, array)
+       os.replace(tmp_file, entry)
+    return np.load(entry, mmap_mode="r")
+
+def store_value(cache_dir, name, key, compute):
+    '''
+    This function returns a stored json-serialisable value (e.g. the
+    total weight of a region), memoised in cache_dir/<name>.json and
+    computed by compute() on a miss.
+    '''
+    index_file = os.path.join(cache_dir, name + ".json")
+    index = {}
+    if os.path.exists(index_file):
+       with open(index_file) as f:
+            index = json.load(f)
+    if key in index:
+       return index[key]
+
+    index[key] = value = compute()
+    tmp_file = f"{index_file}.{os.getpid()}"
+    with open(tmp_file, "w") as f:
+         json.dump(index, f, indent=2)
+    os.replace(tmp_file, index_file)
+    return value
 
 # =====================================================================================================
 
@@ -30,6 +30,19 @@ export SCRPATH=${MARINE_VAL}/SCRIPT/
 # (working dir for $RUNID = $DATPATH/$RUNID)
 export DATPATH=${DATADIR}/MARINE_VAL/
 
+# tmask cache shared by all RUNIDs (masks are keyed by mesh content and domain parameters)
+# leave TMASK_CACHE empty to disable it; TMASK_CACHE_SIZE is the cache size limit in GB
+export TMASK_CACHE=${DATPATH}/TMASK_CACHE
+export TMASK_CACHE_SIZE=10
+
+# weights store shared by all RUNIDs (static weights products such as e1t*e2t, keyed by mesh content)
+# used by reduce_fields.py, section_index.py (section geometry) and seawater_state.py (sea pressure), leave WEIGHTS_STORE empty to disable it
+export WEIGHTS_STORE=${DATPATH}/WEIGHTS_STORE
+
+# socket of a resident reduce_fields.py worker, started with SCRIPT/reduce_worker.py -s $REDUCE_SOCKET &
+# reduce_fields.py runs the reductions itself when REDUCE_SOCKET is empty or no worker is listening on it
+export REDUCE_SOCKET=
+
 # Observations
 # 1) Observations for HTC, STC and MEDOVF
 export OBSPATH=YOUR/LOCAL/PATH/OBS_PATH_DIR
@@ -307,25 +307,18 @@ for RUNID in `echo $RUNIDS`; do
             fi
 
             [[ $runBSF_SO == 1 ]]  && run_tool mk_psi_SO                 $TAG $RUNID $FREQ $mooVyid:$mooUyid
-            [[ $runDEEPTS == 1 ]]  && run_tool mk_deepTS -A AMU          $TAG $RUNID $FREQ $mooTyid
-            [[ $runDEEPTS == 1 ]]  && run_tool mk_deepTS -A WROSS        $TAG $RUNID $FREQ $mooTyid
+            [[ $runDEEPTS == 1 ]]  && run_tool mk_deepTS -A AMU,WROSS    $TAG $RUNID $FREQ $mooTyid
             [[ $runSST_SO == 1 ]]  && run_tool mk_sst_SO                 $TAG $RUNID $FREQ $mooTyid
-            [[ $runACC == 1 ]]     && run_tool mk_trp  -S ACC            $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runACC == 1 ]]     && run_tool mk_trp  -S ACC -B         $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runACC == 1 ]]     && run_tool mk_trp  -s ACC-shelfbreak $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runNAtlOverflows == 1 ]] && run_tool mk_trp  -S DenmarkStrait      $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runNAtlOverflows == 1 ]] && run_tool mk_trp  -S FaroeBankChannel   $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runArcTrans == 1 ]]      && run_tool mk_trp  -S FramStrait         $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runArcTrans == 1 ]]      && run_tool mk_trp  -S BeringStrait       $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runArcTrans == 1 ]]      && run_tool mk_trp  -S DavisStrait        $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runArcTrans == 1 ]]      && run_tool mk_trp  -S BarentsSea         $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runArcTrans == 1 ]]      && run_tool mk_trp  -S WSC                $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runMargSea == 1 ]]       && run_tool mk_trp  -S GibraltarStrait    $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runMargSea == 1 ]]       && run_tool mk_trp  -S BabElMandeb        $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runMargSea == 1 ]]       && run_tool mk_trp  -S StraitOfHormuz     $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid 
-            [[ $runITF == 1 ]]           && run_tool mk_trp  -S LombokStrait       $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runITF == 1 ]]           && run_tool mk_trp  -S OmbaiStrait        $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
-            [[ $runITF == 1 ]]           && run_tool mk_trp  -S TimorPassage       $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid 
+            # all the sections of the TAG in one job, reading the U/V/T files once
+            TRP_SECTIONS=""
+            [[ $runACC == 1 ]]           && TRP_SECTIONS="$TRP_SECTIONS,ACC,ACC-shelfbreak"
+            [[ $runNAtlOverflows == 1 ]] && TRP_SECTIONS="$TRP_SECTIONS,DenmarkStrait,FaroeBankChannel"
+            [[ $runArcTrans == 1 ]]      && TRP_SECTIONS="$TRP_SECTIONS,FramStrait,BeringStrait,DavisStrait,BarentsSea,WSC"
+            [[ $runMargSea == 1 ]]       && TRP_SECTIONS="$TRP_SECTIONS,GibraltarStrait,BabElMandeb,StraitOfHormuz"
+            [[ $runITF == 1 ]]           && TRP_SECTIONS="$TRP_SECTIONS,LombokStrait,OmbaiStrait,TimorPassage"
+            TRP_BOTTOM=""
+            [[ $runACC == 1 ]]           && TRP_BOTTOM="-A ACC"
+            [[ -n "$TRP_SECTIONS" ]]    && run_tool mk_trps -S ${TRP_SECTIONS#,} $TRP_BOTTOM $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid
             [[ $runBSF_NA == 1 ]]        && run_tool mk_psi_NA    $TAG $RUNID $FREQ $mooVyid:$mooUyid
             if [[ $runVRMP == 1 ]]; then
                [[ $runAMOC == 1 ]] && run_tool mk_amoc $TAG $RUNID $FREQ $mooVyid:$mooUyid:$mooTyid:$vrmp_sbatch
@@ -382,8 +375,7 @@ for RUNID in `echo $RUNIDS`; do
 
       # run cdftools
       for TAG in $TAGDJF_LIST;do
-         [[ $runDEEPTS == 1 ]]  && run_tool mk_deepTS -A WWED $TAG $RUNID 1s $mooDJFsid
-         [[ $runDEEPTS == 1 ]]  && run_tool mk_deepTS -A EROSS $TAG $RUNID 1s $mooDJFsid
+         [[ $runDEEPTS == 1 ]]  && run_tool mk_deepTS -A WWED,EROSS $TAG $RUNID 1s $mooDJFsid
       done
       for TAG in $TAG09_LIST;do
          [[ $runMLD_Weddell == 1 ]] && run_tool mk_mxl_SO  $TAG $RUNID 1m    $mooT09mid